@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Admission control: at most max_active requests per model generate at the same time, and at most max_queue
+# wait for their turn (for up to timeout seconds). Everything else gets a 429 with Retry-After right away, so
+# the requests which were admitted keep a stable latency under overload instead of everyone slowing down.
+#
+# Waiting requests are served by priority class, then in order. When the queue is full a request with a
+# higher priority takes the place of the last one with a lower priority, which gets the 429 instead.
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+from loguru import logger
+
+from openedai import RateLimitError
+import metrics
+
+PRIORITIES = { 'interactive': 0, 'normal': 1, 'bulk': 2 }
+
+class admission_slot():
+    # a place among the active requests until release(), or until the request that holds it is gone
+    def __init__(self, gate):
+        self.gate = gate
+        self.start = time.time()
+
+    def release(self):
+        if self.gate:
+            gate, self.gate = self.gate, None
+            gate._release(time.time() - self.start)
+
+    __del__ = release
+
+    async def hold(self, content):
+        # releases the slot when the response is done
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            await content.aclose()
+            self.release()
+
+class admission_gate():
+    def __init__(self, name: str, max_active: int, max_queue: int = None, timeout: float = None):
+        self.name = name
+        self.max_active = max_active
+        self.max_queue = max_queue # None waits without a limit
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = [] # heap of (priority, order, future)
+        self.order = itertools.count()
+        self.service_time = 1.0 # moving average of how long a request holds its slot, for Retry-After
+        self.loop = None
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.service_time * (len(self.waiting) + 1) / self.max_active))
+
+    def _rejected(self, reason: str) -> RateLimitError:
+        metrics.admission_rejected.inc(model=self.name, reason=reason)
+        return RateLimitError(f"Too many requests for {self.name}, please try again later.", retry_after=self._retry_after(),
+                              internal_message=f"{self.name}: {self.active} active, {len(self.waiting)} waiting, {reason}")
+
+    def _remove(self, entry):
+        if entry in self.waiting:
+            self.waiting.remove(entry)
+            heapq.heapify(self.waiting)
+        metrics.admission_queue.set(len(self.waiting), model=self.name)
+
+    def _grant(self):
+        while self.active < self.max_active and self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if future.done(): # timed out or gone
+                continue
+            self.active += 1
+            future.set_result(None)
+        metrics.admission_queue.set(len(self.waiting), model=self.name)
+
+    def _release(self, held: float):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if not in_loop: # released by the garbage collector in another thread
+            try:
+                self.loop.call_soon_threadsafe(self._release, held)
+            except RuntimeError: # event loop is closed
+                pass
+            return
+
+        self.service_time = 0.9 * self.service_time + 0.1 * held
+        self.active -= 1
+        self._grant()
+
+    async def acquire(self, priority: int = PRIORITIES['normal']) -> admission_slot:
+        self.loop = asyncio.get_running_loop()
+        if self.active < self.max_active and not self.waiting:
+            self.active += 1
+            return admission_slot(self)
+
+        if self.max_queue is not None and len(self.waiting) >= self.max_queue:
+            last = max(self.waiting, default=None)
+            if last is None or last[0] <= priority:
+                raise self._rejected('queue full')
+            # make room by turning away the last request with a lower priority
+            self._remove(last)
+            last[2].set_exception(self._rejected('preempted'))
+
+        future = self.loop.create_future()
+        entry = (priority, next(self.order), future)
+        heapq.heappush(self.waiting, entry)
+        metrics.admission_queue.set(len(self.waiting), model=self.name)
+
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._remove(entry)
+            raise self._rejected('timeout')
+        except asyncio.CancelledError: # client gone
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.active -= 1 # it was granted just before
+                self._grant()
+            self._remove(entry)
+            raise
+
+        return admission_slot(self)
+
+def per_model(value: str, models: list) -> dict:
+    # '8' -> { model: 8 for every model }, 'tts-1=8,tts-1-hd=2' -> { 'tts-1': 8, 'tts-1-hd': 2 }
+    if value is None:
+        return {}
+    if '=' not in value:
+        return { model: int(value) for model in models }
+    result = {}
+    for item in value.split(','):
+        model, number = item.split('=', 1)
+        result[model.strip()] = int(number)
+    return result
+
+def priority_keys(value: str) -> dict:
+    # 'sk-abc=interactive,sk-xyz=bulk' -> { api key: class }
+    result = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        key, priority = item.rsplit('=', 1)
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority class: {priority}, must be one of {', '.join(PRIORITIES)}")
+        result[key.strip()] = priority
+    return result
+
+def request_priority(priority_keys: dict, authorization: str = None, x_priority: str = None) -> int:
+    # the class of the api key, or the X-Priority header (interactive, normal or bulk)
+    if authorization and priority_keys:
+        key = authorization.split(' ', 1)[-1].strip()
+        if key in priority_keys:
+            return PRIORITIES[priority_keys[key]]
+    if x_priority:
+        if x_priority.lower() in PRIORITIES:
+            return PRIORITIES[x_priority.lower()]
+        logger.debug(f"Unknown X-Priority: {x_priority}")
+    return PRIORITIES['normal']
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# Encoders for the generated pcm: pcm and wav are converted in process, everything else goes through
+# PyAV (in process, optional) or ffmpeg, with a few ffmpeg processes started ahead of time.
+import asyncio
+import struct
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+
+import metrics
+
+def build_ffmpeg_args(response_format, input_format, sample_rate):
+    # Convert the output to the desired format using ffmpeg
+    if input_format == 'WAV':
+        ffmpeg_args = ["ffmpeg", "-loglevel", "error", "-f", "WAV", "-i", "-"]
+    else:
+        ffmpeg_args = ["ffmpeg", "-loglevel", "error", "-f", input_format, "-ar", sample_rate, "-ac", "1", "-i", "-"]
+
+    if response_format == "mp3":
+        ffmpeg_args.extend(["-f", "mp3", "-c:a", "libmp3lame", "-ab", "64k"])
+    elif response_format == "opus":
+        ffmpeg_args.extend(["-f", "ogg", "-c:a", "libopus"])
+    elif response_format == "aac":
+        ffmpeg_args.extend(["-f", "adts", "-c:a", "aac", "-ab", "64k"])
+    elif response_format == "flac":
+        ffmpeg_args.extend(["-f", "flac", "-c:a", "flac"])
+    elif response_format == "wav":
+        ffmpeg_args.extend(["-f", "wav", "-c:a", "pcm_s16le"])
+    elif response_format == "pcm": # pcm and wav are encoded in process (pcm_encoder), these match its output
+        ffmpeg_args.extend(["-f", "s16le", "-c:a", "pcm_s16le"])
+
+    return ffmpeg_args
+
+def wav_header(sample_rate: int) -> bytes:
+    # streaming wav, the sizes are unknown so they are set to the maximum (like ffmpeg does on a pipe)
+    return b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE' + \
+        b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16) + \
+        b'data' + struct.pack('<I', 0xFFFFFFFF)
+
+def to_float(pcm: np.ndarray) -> np.ndarray:
+    if pcm.dtype == np.int16:
+        return pcm.astype(np.float32) / 32768.0
+    return pcm
+
+def to_s16le(pcm: np.ndarray) -> bytes:
+    if pcm.dtype == np.int16:
+        return pcm.tobytes()
+    return np.clip(np.rint(pcm * 32768.0), -32768, 32767).astype('<i2').tobytes()
+
+class linear_resampler():
+    # streaming linear interpolation, keeps the last sample and the position between chunks
+    def __init__(self, in_rate: int, out_rate: int):
+        self.step = in_rate / out_rate
+        self.pos = 0.0
+        self.prev = None
+
+    def resample(self, x: np.ndarray) -> np.ndarray:
+        x = to_float(x)
+        buf = np.concatenate([self.prev, x]) if self.prev is not None else x
+        if len(buf) < 1:
+            return buf
+
+        last = len(buf) - 1
+        n = int((last - self.pos) // self.step) + 1 if last >= self.pos else 0
+        y = np.interp(self.pos + self.step * np.arange(n), np.arange(len(buf)), buf).astype(np.float32)
+
+        self.pos = self.pos + n * self.step - last
+        self.prev = buf[-1:]
+        return y
+
+class pcm_encoder():
+    # f32le or s16le -> s16le pcm or wav, optionally resampled, without starting ffmpeg
+    def __init__(self, response_format: str, input_format: str, sample_rate: int, out_rate: int = None):
+        self.dtype = np.dtype('<f4') if input_format == 'f32le' else np.dtype('<i2')
+        self.sample_rate = out_rate or sample_rate
+        self.resampler = linear_resampler(sample_rate, out_rate) if out_rate and out_rate != sample_rate else None
+        self.header = wav_header(self.sample_rate) if response_format == 'wav' else b''
+        self.rest = b''
+
+    def encode(self, chunk: bytes) -> bytes:
+        if self.rest:
+            chunk = self.rest + chunk
+        n = len(chunk) - len(chunk) % self.dtype.itemsize
+        self.rest = chunk[n:]
+
+        pcm = np.frombuffer(chunk, dtype=self.dtype, count=n // self.dtype.itemsize)
+        if self.resampler:
+            pcm = self.resampler.resample(pcm)
+
+        out = self.header + to_s16le(pcm)
+        self.header = b''
+        return out
+
+    def flush(self) -> bytes:
+        out = self.header
+        self.header = b''
+        return out
+
+class av_encoder():
+    # in process mp3/opus/aac/flac encoding with PyAV, formats and settings match build_ffmpeg_args()
+    formats = {
+        'mp3': ('mp3', 'libmp3lame', 64000),
+        'opus': ('ogg', 'libopus', None),
+        'aac': ('adts', 'aac', 64000),
+        'flac': ('flac', 'flac', None),
+    }
+
+    def __init__(self, response_format: str, input_format: str, sample_rate: int):
+        import av
+
+        self.av = av
+        self.out = bytearray()
+        self.format = 'flt' if input_format == 'f32le' else 's16'
+        self.dtype = np.dtype('<f4') if input_format == 'f32le' else np.dtype('<i2')
+        self.sample_rate = sample_rate
+        self.rest = b''
+
+        container_format, codec, bit_rate = self.formats[response_format]
+        self.container = av.open(self, mode='w', format=container_format)
+        self.stream = self.container.add_stream(codec, rate=48000 if codec == 'libopus' else sample_rate)
+        self.stream.layout = 'mono'
+        if bit_rate:
+            self.stream.bit_rate = bit_rate
+        self.resampler = av.AudioResampler(format=self.stream.codec_context.codec.audio_formats[0].name, layout='mono', rate=self.stream.rate)
+
+    def write(self, data) -> int: # output of the av container
+        self.out.extend(data)
+        return len(data)
+
+    def _drain(self) -> bytes:
+        out = bytes(self.out)
+        self.out.clear()
+        return out
+
+    def _encode(self, frame):
+        for resampled in self.resampler.resample(frame):
+            for packet in self.stream.encode(resampled):
+                self.container.mux(packet)
+        if frame is None:
+            for packet in self.stream.encode(None):
+                self.container.mux(packet)
+
+    def encode(self, chunk: bytes) -> bytes:
+        if self.rest:
+            chunk = self.rest + chunk
+        n = len(chunk) - len(chunk) % self.dtype.itemsize
+        self.rest = chunk[n:]
+        if n:
+            pcm = np.frombuffer(chunk, dtype=self.dtype, count=n // self.dtype.itemsize)
+            frame = self.av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format=self.format, layout='mono')
+            frame.sample_rate = self.sample_rate
+            self._encode(frame)
+        return self._drain()
+
+    def flush(self) -> bytes:
+        self._encode(None)
+        self.container.close()
+        return self._drain()
+
+async def threaded_iter(sync_iter, maxsize: int = 32):
+    # Runs a blocking iterator (piper, xtts) in its own thread and hands the items to the event loop.
+    # At most maxsize items are buffered, after that the thread waits, and it stops if the reader goes away.
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    space = threading.Semaphore(maxsize)
+    cancelled = threading.Event()
+    done = object()
+
+    def put(item, e=None):
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, (item, e))
+        except RuntimeError: # event loop is closed
+            cancelled.set()
+
+    def run():
+        try:
+            for item in sync_iter:
+                while not space.acquire(timeout=0.1):
+                    if cancelled.is_set():
+                        return
+                if cancelled.is_set():
+                    return
+                put(item)
+            put(done)
+
+        except BaseException as e:
+            put(done, e)
+
+        finally:
+            if hasattr(sync_iter, 'close'):
+                sync_iter.close()
+
+    threading.Thread(target=run, daemon=True).start()
+
+    try:
+        while True:
+            item, e = await items.get()
+            if item is done:
+                if e:
+                    raise e
+                return
+            space.release()
+            yield item
+    finally:
+        cancelled.set()
+
+class encoder_stream():
+    # The encoded output of one request: iterate .content, .completed() is True when all the pcm
+    # was encoded without errors, close() stops everything.
+    def __init__(self, pcm_iter, trace=None):
+        self.pcm_iter = pcm_iter
+        self.trace = trace
+        self.finished = False
+        self.proc = None
+
+    async def inprocess(self, encoder):
+        try:
+            async for chunk in self.pcm_iter:
+                out = encoder.encode(chunk)
+                if out:
+                    yield out
+            out = encoder.flush()
+            if out:
+                yield out
+            self.finished = True
+        finally:
+            await self.pcm_iter.aclose()
+
+    async def ffmpeg(self, encoders, ffmpeg_args: list):
+        start = time.time()
+        proc = self.proc = await encoders.ffmpeg(ffmpeg_args)
+        if self.trace:
+            self.trace.add('encoder_start', time.time() - start)
+        written = False
+
+        async def writer():
+            # pcm -> ffmpeg
+            nonlocal written
+            try:
+                async for chunk in self.pcm_iter:
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain() # BrokenPipeError/ConnectionResetError from here if ffmpeg is gone
+                written = True
+
+            except (BrokenPipeError, ConnectionResetError) as e:
+                logger.info("ffmpeg closed - 'Broken pipe'")
+
+            except Exception as e:
+                logger.error(f"Exception: {repr(e)}")
+                proc.kill()
+
+            finally:
+                await self.pcm_iter.aclose()
+                try:
+                    proc.stdin.close()
+                except Exception:
+                    pass
+
+        writer_task = asyncio.create_task(writer())
+        try:
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk:
+                    break
+                yield chunk
+
+            await writer_task
+            self.finished = written and await proc.wait() == 0
+
+        finally:
+            if not writer_task.done():
+                writer_task.cancel()
+            self.close()
+
+    def completed(self) -> bool:
+        return self.finished
+
+    def close(self):
+        if self.proc and self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+
+class audio_encoders():
+    def __init__(self, backend: str = 'ffmpeg', prespawn: int = 0):
+        self.backend = backend
+        self.prespawn = prespawn
+        self.idle = {} # ffmpeg args -> started ffmpeg processes
+        self.refilling = set() # ffmpeg args with a _refill() running, one at a time so there are at most prespawn
+
+        if self.backend == 'pyav':
+            try:
+                import av
+            except ImportError:
+                logger.error("PyAV not found (pip install av), using ffmpeg instead")
+                self.backend = 'ffmpeg'
+
+    async def _spawn(self, ffmpeg_args: tuple):
+        with metrics.spawn_seconds.time(process='ffmpeg'):
+            return await asyncio.create_subprocess_exec(*ffmpeg_args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+
+    async def _refill(self, ffmpeg_args: tuple):
+        if ffmpeg_args in self.refilling:
+            return
+        self.refilling.add(ffmpeg_args)
+        try:
+            idle = self.idle[ffmpeg_args]
+            while len(idle) < self.prespawn:
+                idle.append(await self._spawn(ffmpeg_args))
+        finally:
+            self.refilling.discard(ffmpeg_args)
+
+    async def ffmpeg(self, ffmpeg_args: list):
+        # a started ffmpeg, from the idle processes if there are any, and start a replacement in the background
+        if not self.prespawn:
+            return await self._spawn(ffmpeg_args)
+
+        ffmpeg_args = tuple(ffmpeg_args)
+        idle = self.idle.setdefault(ffmpeg_args, [])
+
+        proc = None
+        while idle and proc is None:
+            proc = idle.pop(0)
+            if proc.returncode is not None: # died while waiting
+                proc = None
+        if proc is None:
+            proc = await self._spawn(ffmpeg_args)
+
+        asyncio.create_task(self._refill(ffmpeg_args))
+        return proc
+
+    def stream(self, pcm_iter, response_format: str, input_format: str, sample_rate: str, out_rate: str = None, trace=None) -> encoder_stream:
+        # pcm_iter is an async iterator of raw pcm
+        stream = encoder_stream(pcm_iter, trace)
+
+        if response_format in ['pcm', 'wav']:
+            encoder = pcm_encoder(response_format, input_format, int(sample_rate), int(out_rate) if out_rate and response_format == 'pcm' else None)
+            stream.content = stream.inprocess(encoder)
+
+        elif self.backend == 'pyav':
+            stream.content = stream.inprocess(av_encoder(response_format, input_format, int(sample_rate)))
+
+        else:
+            ffmpeg_args = build_ffmpeg_args(response_format, input_format=input_format, sample_rate=str(sample_rate))
+            ffmpeg_args.extend(["-"])
+            stream.content = stream.ffmpeg(self, ffmpeg_args)
+
+        return stream
+
+    def shutdown(self):
+        for idle in self.idle.values():
+            for proc in idle:
+                if proc.returncode is None:
+                    proc.kill()
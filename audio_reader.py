@@ -6,94 +6,105 @@ except ImportError:
     pass
 
 import argparse
+import concurrent.futures
 import os
 import pysbd
 import queue
+import re
 import sys
-import tempfile
 import threading
-import shutil
-import sys
-import tempfile
-import contextlib
 
 import openai
 
 try:
-    from playsound import playsound
+    import sounddevice
 except ImportError:
-    print("Error: missing required package 'playsound'. !pip install playsound")
+    print("Error: missing required package 'sounddevice'. !pip install sounddevice")
     sys.exit(1)
 
-@contextlib.contextmanager
-def tempdir():
-    path = tempfile.mkdtemp()
-    try:
-        yield path
-    finally:
-        try:
-            shutil.rmtree(path)
-        except IOError:
-            sys.stderr.write('Failed to clean up temp dir {}'.format(path))
-
 class SimpleAudioPlayer:
-    def __init__(self):
-        self._queue = queue.Queue()
-        self.running = True
+    # Plays the pcm of each sentence in order on one output stream, so there are no gaps between them.
+    # At most prefetch sentences are queued (and being requested), put() waits after that.
+    def __init__(self, prefetch: int = 4):
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stream = None
         self._thread = threading.Thread(target=self.__play_audio_loop, daemon=True)
         self._thread.start()
 
-    def put(self, file):
-        self._queue.put(file)
+    def put(self, future):
+        # future -> (sample rate, pcm)
+        self._queue.put(future)
 
     def stop(self):
-        self.running = False
+        # plays what is queued and waits for it to finish
+        self._queue.put(None)
         self._thread.join()
+
+    def cancel(self):
         try:
             while True:
-                file = self._queue.get_nowait()
-                if os.path.exists(file):
-                    os.unlink(file)
+                future = self._queue.get_nowait()
+                if future:
+                    future.cancel()
         except queue.Empty as e:
             pass
+        self._queue.put(None)
 
     def __play_audio_loop(self):
-        while self.running:
-            try:
-                while True:
-                    file = self._queue.get(block=True, timeout=0.01)
-
-                    try:
-                        playsound(file)
-                    finally:
-                        os.unlink(file)
-
-            except queue.Empty as e:
-                continue
+        try:
+            while True:
+                future = self._queue.get()
+                if future is None:
+                    break
+
+                try:
+                    sample_rate, pcm = future.result()
+                except concurrent.futures.CancelledError:
+                    continue
+                except Exception as e:
+                    sys.stderr.write(f"Error: {repr(e)}\n")
+                    continue
+
+                if self._stream is None or self._stream.samplerate != sample_rate:
+                    if self._stream is not None:
+                        self._stream.stop()
+                        self._stream.close()
+                    self._stream = sounddevice.RawOutputStream(samplerate=sample_rate, channels=1, dtype='int16')
+                    self._stream.start()
+
+                self._stream.write(pcm)
+        finally:
+            if self._stream is not None:
+                self._stream.stop() # waits for the buffered audio to play
+                self._stream.close()
 
 class OpenAI_tts:
-    def __init__(self, model, voice, speed, base_dir):
-        self.base_dir = base_dir
+    def __init__(self, model, voice, speed, prefetch: int = 4):
+        # the requests share the client's connection pool, the connections are kept open between sentences
         self.openai_client = openai.OpenAI(
             # export OPENAI_API_KEY=sk-11111111111
             # export OPENAI_BASE_URL=http://localhost:8000/v1
             api_key = os.environ.get("OPENAI_API_KEY", "sk-ip"),
             base_url = os.environ.get("OPENAI_BASE_URL", "http://localhost:8000/v1"),
         )
-        
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch)
+
         self.params = {
             'model': model,
             'voice': voice,
             'speed': speed
         }
 
-    def speech_to_file(self, text: str) -> None:
+    def speech_to_pcm(self, text: str) -> tuple:
+        # -> (sample rate, s16le pcm), in memory
         with self.openai_client.audio.speech.with_streaming_response.create(
-                input=text, response_format='opus', **self.params
+                input=text, response_format='pcm', **self.params
             ) as response:
-            tf, output_filename = tempfile.mkstemp(suffix='.wav', prefix="audio_reader_", dir=self.base_dir)
-            response.stream_to_file(output_filename)
-            return output_filename
+            rate = re.search(r'rate=(\d+)', response.headers.get('content-type', ''))
+            return int(rate.group(1)) if rate else 24000, response.read()
+
+    def submit(self, text: str) -> concurrent.futures.Future:
+        return self.executor.submit(self.speech_to_pcm, text)
 
 
 if __name__ == "__main__":
@@ -103,25 +114,28 @@ if __name__ == "__main__":
 
     parser.add_argument('-m', '--model', action='store', default="tts-1", help="The OpenAI model")
     parser.add_argument('-v', '--voice', action='store', default="alloy", help="The voice to use")
-    parser.add_argument('-s', '--speed', action='store', default=1.0, help="How fast to read the audio")
+    parser.add_argument('-s', '--speed', action='store', default=1.0, type=float, help="How fast to read the audio")
+    parser.add_argument('-k', '--prefetch', action='store', default=4, type=int, help="Number of sentences requested ahead of the one playing")
 
     args = parser.parse_args()
 
+    player = SimpleAudioPlayer(prefetch=args.prefetch)
+    reader = OpenAI_tts(voice=args.voice, model=args.model, speed=args.speed, prefetch=args.prefetch)
     try:
-        with tempdir() as base_dir:
-            player = SimpleAudioPlayer()
-            reader = OpenAI_tts(voice=args.voice, model=args.model, speed=args.speed, base_dir=base_dir)
-            seg = pysbd.Segmenter(language='en', clean=True) # text is dirty, clean it up.
+        seg = pysbd.Segmenter(language='en', clean=True) # text is dirty, clean it up.
 
-            for raw_line in sys.stdin:
-                for line in seg.segment(raw_line):
-                    if not line:
-                        continue
+        for raw_line in sys.stdin:
+            for line in seg.segment(raw_line):
+                if not line:
+                    continue
 
-                    print(line)
-                    player.put(reader.speech_to_file(line))
+                print(line)
+                player.put(reader.submit(line))
 
-            player.stop()
+        player.stop()
 
     except KeyboardInterrupt:
-        pass
+        player.cancel()
+
+    finally:
+        reader.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Batch speech jobs: a jsonl of speech requests (one per line, like the /v1/audio/speech body, with an optional
+# custom_id) is queued as a job and rendered in the background to a directory, or a zip archive when it's done.
+#
+# The items of a job are rendered grouped by model and voice, so the model stays loaded and the speaker latents
+# stay cached. Batch items ask for the bulk priority class, and a new item isn't started while interactive
+# requests are streaming (for up to yield_seconds), so interactive traffic goes first.
+import asyncio
+import collections
+import json
+import os
+import re
+import time
+import uuid
+import zipfile
+
+from loguru import logger
+
+from openedai import RateLimitError
+
+class batch_job():
+    def __init__(self, id: str, items: list, output_dir: str, archive: bool = False):
+        self.id = id
+        self.items = items # [(index, request dict)] in the order they are rendered
+        self.output_dir = output_dir
+        self.archive = archive
+        self.status = 'queued' # queued, running, completed, cancelled
+        self.created_at = int(time.time())
+        self.completed_at = None
+        self.total = 0
+        self.completed = 0
+        self.errors = [] # { 'index', 'custom_id', 'message' }
+        self.next = 0 # next item to render
+        self.running = 0 # items being rendered
+
+    def info(self) -> dict:
+        return {
+            'id': self.id,
+            'object': 'speech.batch',
+            'status': self.status,
+            'created_at': self.created_at,
+            'completed_at': self.completed_at,
+            'total': self.total,
+            'completed': self.completed,
+            'failed': len(self.errors),
+            'errors': self.errors,
+            'output': f"{self.output_dir}.zip" if self.archive and self.status == 'completed' else self.output_dir,
+        }
+
+    def fail(self, index: int, item: dict, message: str):
+        self.errors.append({ 'index': index, 'custom_id': item.get('custom_id', None), 'message': message })
+
+def _filename(index: int, item: dict) -> str:
+    name = f"{index:05d}"
+    if item.get('custom_id'):
+        name += '-' + re.sub(r'[^\w.-]+', '_', str(item['custom_id']))[:100]
+    return f"{name}.{str(item.get('response_format', 'mp3')).lower()}"
+
+class batch_runner():
+    def __init__(self, synthesize, validate, output_dir: str, workers: int = 1, busy=None, yield_seconds: float = 5.0,
+                 max_retries: int = 100, keep_seconds: int = 24 * 3600, max_jobs: int = 1000):
+        self.synthesize = synthesize # async (request dict) -> bytes
+        self.validate = validate # request dict -> raises on a bad request
+        self.output_dir = output_dir
+        self.workers = workers
+        self.busy = busy # () -> number of interactive requests streaming
+        self.yield_seconds = yield_seconds
+        self.max_retries = max_retries # of an item turned away with a 429, before it fails
+        self.keep_seconds = keep_seconds # finished jobs are forgotten after this (their output stays on disk),
+        self.max_jobs = max_jobs # or sooner, oldest first, when there are more jobs than this
+        self.jobs = collections.OrderedDict() # id -> batch_job
+        self.ready = None # asyncio.Event, work was queued
+        self.tasks = []
+        self.rendering = 0 # batch items being rendered, they are streams too
+
+    def submit(self, jsonl: str, archive: bool = False) -> batch_job:
+        job_id = f"batch_{uuid.uuid4().hex[:24]}"
+        job = batch_job(job_id, [], os.path.join(self.output_dir, job_id), archive)
+
+        items = []
+        for index, line in enumerate(line for line in jsonl.splitlines() if line.strip()):
+            try:
+                item = json.loads(line)
+                self.validate({ k: v for k, v in item.items() if k != 'custom_id' })
+                items.append((index, item))
+            except Exception as e:
+                job.fail(index, {}, f"Invalid request: {e}")
+            job.total += 1
+
+        # grouped by model and voice, in order within the group
+        job.items = sorted(items, key=lambda entry: (str(entry[1].get('model', 'tts-1')), str(entry[1].get('voice', 'alloy')), entry[0]))
+        os.makedirs(job.output_dir, exist_ok=True)
+        self._expire()
+        self.jobs[job_id] = job
+        logger.info(f"Batch {job_id} queued: {job.total} items")
+        if job.items:
+            self._save(job)
+            self.ready.set()
+        else:
+            asyncio.create_task(self._finish(job))
+        return job
+
+    def get(self, job_id: str) -> batch_job:
+        return self.jobs.get(job_id, None)
+
+    def cancel(self, job_id: str) -> batch_job:
+        job = self.jobs.get(job_id, None)
+        if job and job.status in ['queued', 'running']:
+            job.next = len(job.items) # the items being rendered are finished
+            job.status = 'cancelled'
+            job.completed_at = int(time.time())
+            self._save(job)
+        return job
+
+    def _expire(self):
+        finished = [job for job in self.jobs.values() if job.status in ['completed', 'cancelled'] and job.running == 0]
+        expired = [job for job in finished if job.completed_at and job.completed_at < time.time() - self.keep_seconds]
+        over = len(self.jobs) + 1 - self.max_jobs - len(expired) # with room for the new job
+        expired += [job for job in finished if job not in expired][:max(0, over)]
+        for job in expired:
+            del self.jobs[job.id]
+        if expired:
+            logger.debug(f"Forgot {len(expired)} finished batches")
+
+    def _save(self, job: batch_job):
+        try:
+            with open(os.path.join(job.output_dir, 'status.json'), 'w', encoding='utf8') as f:
+                json.dump(job.info(), f, indent=2)
+        except OSError as e:
+            logger.error(f"Failed to save batch status {job.id}: {repr(e)}")
+
+    def _next_item(self):
+        for job in self.jobs.values():
+            if job.status in ['queued', 'running'] and job.next < len(job.items):
+                job.status = 'running'
+                index, item = job.items[job.next]
+                job.next += 1
+                job.running += 1
+                return job, index, item
+        return None
+
+    async def _wait_for_idle(self):
+        deadline = time.time() + self.yield_seconds
+        while self.busy and self.busy() - self.rendering > 0 and time.time() < deadline:
+            await asyncio.sleep(0.1)
+
+    async def _render(self, job: batch_job, index: int, item: dict) -> bool:
+        # -> False if the job was cancelled before the item was rendered
+        request = { k: v for k, v in item.items() if k != 'custom_id' }
+        for retry in range(self.max_retries + 1):
+            if job.status == 'cancelled':
+                return False
+            self.rendering += 1
+            try:
+                audio = await self.synthesize(request)
+                break
+            except RateLimitError as e: # bulk requests are the first to be turned away, try again later
+                if retry == self.max_retries:
+                    raise
+                retry_after = int((e.headers or {}).get('Retry-After', 1))
+            finally:
+                self.rendering -= 1
+            await asyncio.sleep(retry_after)
+
+        path = os.path.join(job.output_dir, _filename(index, item))
+
+        def write():
+            with open(path + '.tmp', 'wb') as f:
+                f.write(audio)
+            os.replace(path + '.tmp', path)
+
+        await asyncio.to_thread(write)
+        return True
+
+    async def _finish(self, job: batch_job):
+        if job.archive:
+            def pack():
+                # the audio is already compressed
+                with zipfile.ZipFile(job.output_dir + '.zip', 'w', compression=zipfile.ZIP_STORED) as archive:
+                    for name in sorted(os.listdir(job.output_dir)):
+                        if name != 'status.json':
+                            archive.write(os.path.join(job.output_dir, name), name)
+            await asyncio.to_thread(pack)
+
+        job.status = 'completed'
+        job.completed_at = int(time.time())
+        self._save(job)
+        logger.info(f"Batch {job.id} completed: {job.completed} done, {len(job.errors)} failed")
+
+    async def _worker(self):
+        while True:
+            work = self._next_item()
+            if work is None:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            job, index, item = work
+            await self._wait_for_idle()
+            try:
+                if job.status != 'cancelled' and await self._render(job, index, item):
+                    job.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.fail(index, item, getattr(e, 'message', None) or repr(e))
+                logger.info(f"Batch {job.id} item {index} failed: {repr(e)}")
+            finally:
+                job.running -= 1
+
+            if job.next >= len(job.items) and job.running == 0 and job.status == 'running':
+                await self._finish(job)
+            elif (job.completed + len(job.errors)) % 100 == 0:
+                self._save(job)
+
+    def start(self):
+        self.ready = asyncio.Event() # in the running event loop
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+# Offline benchmark: runs the server in this process with stand-in piper and ffmpeg executables and a fake
+# xtts model, which make deterministic audio at a set speed (no models, gpu or network needed), replays a
+# request mix at a target concurrency and rate, and prints the results as json. Ex.
+#
+#   python bench.py --concurrency 8 --requests 200 > before.json
+#   python bench.py --concurrency 8 --rate 20 --mix requests.jsonl --piper-workers 2 --cache-mb 100
+#
+# Options which aren't for the benchmark are passed on to the server (speech.py). The fake xtts only has
+# inference_stream(), so it can't be used with --xtts-batch-size.
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Shared by the stand-ins: a sine tone, len(text) / chars_per_second seconds long, made at rtf x real time
+FAKE_AUDIO = '''
+import array, math, os, re, time
+
+RTF = float(os.environ.get('BENCH_RTF', '10'))
+CHARS_PER_SECOND = float(os.environ.get('BENCH_CHARS_PER_SECOND', '15'))
+
+def sentences(text):
+    return [s for s in re.split(r'(?<=[.!?])\\s+|\\n+', text.strip()) if s]
+
+def seconds(text, speed=1.0):
+    return max(len(text), 1) / CHARS_PER_SECOND / (speed or 1.0)
+
+def tone(samples, rate, typecode):
+    scale = 8000 if typecode == 'h' else 0.25
+    wave = array.array(typecode, (type(scale)(scale * math.sin(2 * math.pi * 220 * i / rate)) for i in range(samples)))
+    return wave.tobytes()
+
+def pcm(duration, rate, typecode, chunk_samples=None):
+    # yields chunks, paced so the audio is made at RTF x real time
+    total = int(duration * rate)
+    chunk_samples = chunk_samples or total
+    done = 0
+    while done < total:
+        n = min(chunk_samples, total - done)
+        time.sleep(n / rate / RTF)
+        yield tone(n, rate, typecode)
+        done += n
+'''
+
+FAKE_PIPER_CLI = '''
+import os, sys, time
+from bench_fake import sentences, seconds, pcm
+
+length_scale = float(sys.argv[sys.argv.index('--length-scale') + 1]) if '--length-scale' in sys.argv else 1.0
+time.sleep(float(os.environ.get('BENCH_PIPER_START', '0.2'))) # loading the model
+for sentence in sentences(sys.stdin.read()):
+    for chunk in pcm(seconds(sentence) * length_scale, 22050, 'h'):
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+'''
+
+FAKE_FFMPEG = '''
+import os, sys, time
+time.sleep(float(os.environ.get('BENCH_FFMPEG_START', '0.02')))
+while chunk := sys.stdin.buffer.read1(65536):
+    sys.stdout.buffer.write(chunk)
+    sys.stdout.buffer.flush()
+'''
+
+FAKE_MODULES = {
+    'bench_fake.py': FAKE_AUDIO,
+
+    'onnxruntime/__init__.py': '''
+class SessionOptions():
+    intra_op_num_threads = 0
+
+class InferenceSession():
+    def __init__(self, path, sess_options=None, providers=None):
+        self.path = path
+''',
+
+    'piper/__init__.py': '''
+from bench_fake import sentences, seconds, pcm
+
+class PiperVoice():
+    def __init__(self, session=None, config=None):
+        self.session = session
+        self.config = config
+
+    def synthesize_stream_raw(self, text, speaker_id=None, length_scale=None, **kwargs):
+        for sentence in sentences(text):
+            yield b''.join(pcm(seconds(sentence) * (length_scale or 1.0), self.config.sample_rate, 'h'))
+''',
+
+    'piper/config.py': '''
+class PiperConfig():
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+
+    @staticmethod
+    def from_dict(config):
+        return PiperConfig(config['audio']['sample_rate'])
+''',
+
+    'langdetect/__init__.py': '',
+
+    'langdetect/detector_factory.py': '''
+PROFILES_DIRECTORY = None
+
+class Detector():
+    def set_max_text_length(self, max_text_length):
+        pass
+
+    def set_prior_map(self, prior_map):
+        pass
+
+    def append(self, text):
+        pass
+
+    def detect(self):
+        return 'en'
+
+class DetectorFactory():
+    def load_profile(self, profile_directory):
+        pass
+
+    def set_seed(self, seed):
+        pass
+
+    def create(self):
+        return Detector()
+''',
+
+    'TTS/__init__.py': '',
+    'TTS/tts/__init__.py': '',
+    'TTS/tts/configs/__init__.py': '',
+    'TTS/tts/models/__init__.py': '',
+    'TTS/tts/layers/__init__.py': '',
+    'TTS/tts/layers/xtts/__init__.py': '',
+    'TTS/utils/__init__.py': '',
+
+    'TTS/tts/configs/xtts_config.py': '''
+class XttsConfig():
+    def load_json(self, path):
+        self.path = path
+''',
+
+    'TTS/tts/layers/xtts/tokenizer.py': '''
+from bench_fake import sentences
+
+def split_sentence(text, lang, text_split_length=250):
+    return sentences(text)
+''',
+
+    'TTS/utils/manage.py': '''
+import os, tempfile
+
+class ModelManager():
+    def download_model(self, model_name):
+        path = os.path.join(tempfile.gettempdir(), 'bench-xtts', model_name)
+        os.makedirs(path, exist_ok=True)
+        return (path, None, None)
+''',
+
+    'TTS/tts/models/xtts.py': '''
+import collections, os, time
+from bench_fake import seconds, pcm
+
+class tensor():
+    def __init__(self, data=b'', numel=0):
+        self.data = data
+        self._numel = numel
+
+    def cpu(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def numpy(self):
+        return memoryview(self.data).cast('f') # float32 samples, like an array
+
+    def tobytes(self):
+        return self.data
+
+    def numel(self):
+        return self._numel
+
+    def element_size(self):
+        return 4
+
+class tokenizer():
+    char_limits = collections.defaultdict(lambda: 250)
+
+class Xtts():
+    @staticmethod
+    def init_from_config(config):
+        return Xtts()
+
+    def load_checkpoint(self, config, checkpoint_dir=None, use_deepspeed=False):
+        time.sleep(float(os.environ.get('BENCH_XTTS_LOAD', '0.5')))
+        self.tokenizer = tokenizer()
+        self.weights = tensor(numel=int(float(os.environ.get('BENCH_XTTS_MB', '1800')) * 1024 * 1024 / 4))
+
+    def to(self, device=None):
+        return self
+
+    def eval(self):
+        return self
+
+    def parameters(self):
+        return [self.weights]
+
+    def buffers(self):
+        return []
+
+    def get_conditioning_latents(self, audio_path=None, **kwargs):
+        time.sleep(0.05)
+        return tensor(), tensor()
+
+    def inference_stream(self, text, language, gpt_cond_latent, speaker_embedding, stream_chunk_size=20, speed=1.0, **kwargs):
+        # about 1024 samples per gpt token
+        for chunk in pcm(seconds(text, speed), 24000, 'f', stream_chunk_size * 1024):
+            yield tensor(chunk)
+''',
+
+    # only used when torch isn't installed
+    'torch/__init__.py': '''
+import contextlib, pickle
+
+no_grad = contextlib.nullcontext
+
+class cuda():
+    @staticmethod
+    def is_available():
+        return False
+
+class backends():
+    class mps():
+        @staticmethod
+        def is_available():
+            return False
+
+        @staticmethod
+        def is_built():
+            return False
+
+def save(obj, path):
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f)
+
+def load(path, map_location=None):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+''',
+}
+
+# The voices from test_voices.sh
+DEFAULT_MIX = [
+    { 'model': model, 'voice': voice, 'response_format': 'mp3', 'input': f"The quick brown fox jumped over the lazy dog. This {'HD ' if model == 'tts-1-hd' else ''}voice is called {voice}, how do you like this voice?" }
+    for model in ['tts-1', 'tts-1-hd'] for voice in ['alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer']
+]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='OpenedAI Speech offline benchmark, other options are passed on to the server',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--concurrency', action='store', default=4, type=int, help="Maximum requests in flight")
+    parser.add_argument('--rate', action='store', default=0, type=float, help="Requests started per second, 0 starts the next request as soon as one finishes")
+    parser.add_argument('--requests', action='store', default=100, type=int, help="Number of requests to measure")
+    parser.add_argument('--warmup', action='store', default=None, type=int, help="Requests to send before measuring (Ex. to load the models), default is one for each request in the mix")
+    parser.add_argument('--mix', action='store', default=None, help="jsonl file with one speech request per line (model, voice, input, response_format, speed and an optional weight). Lines without 'input' use their 'body' or 'title' as the text. Default is the voices from test_voices.sh")
+    parser.add_argument('--seed', action='store', default=0, type=int, help="Random seed for picking requests from the mix")
+    parser.add_argument('--rtf', action='store', default=10.0, type=float, help="Speed of the fake piper and xtts, seconds of audio per second")
+    parser.add_argument('--chars-per-second', action='store', default=15.0, type=float, help="Speaking rate of the fake voices, sets the length of the audio")
+    parser.add_argument('--piper-start', action='store', default=0.2, type=float, help="Startup time of the fake piper executable in seconds")
+    parser.add_argument('--ffmpeg-start', action='store', default=0.02, type=float, help="Startup time of the fake ffmpeg executable in seconds")
+    parser.add_argument('--xtts-load', action='store', default=0.5, type=float, help="Load time of the fake xtts model in seconds")
+    parser.add_argument('--xtts-mb', action='store', default=1800, type=float, help="Reported size of the fake xtts model in MB")
+    parser.add_argument('--output', action='store', default=None, help="Write the json results to this file instead of stdout")
+
+    return parser.parse_known_args(argv)
+
+def load_mix(path: str) -> list:
+    if not path:
+        return DEFAULT_MIX
+
+    mix = []
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            text = entry.get('input') or entry.get('body') or entry.get('title')
+            if not text:
+                continue
+            mix.append({
+                'model': entry.get('model', 'tts-1'),
+                'voice': entry.get('voice', 'alloy'),
+                'response_format': entry.get('response_format', 'mp3'),
+                'speed': entry.get('speed', 1.0),
+                'input': text,
+                'weight': entry.get('weight', 1),
+            })
+    return mix
+
+def install_fakes(bench_args, fake_dir: str):
+    for name, source in FAKE_MODULES.items():
+        if name.startswith('torch/') and importlib.util.find_spec('torch'):
+            continue
+        path = os.path.join(fake_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(source)
+
+    bin_dir = os.path.join(fake_dir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, source in [('piper', FAKE_PIPER_CLI), ('ffmpeg', FAKE_FFMPEG)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(f"#!{sys.executable}\n{source}")
+        os.chmod(path, 0o755)
+
+    # for this process, the piper worker processes and the executables
+    sys.path.insert(0, fake_dir)
+    os.environ['PYTHONPATH'] = os.pathsep.join([fake_dir, os.environ.get('PYTHONPATH', '')]).rstrip(os.pathsep)
+    os.environ['PATH'] = os.pathsep.join([bin_dir, os.environ.get('PATH', '')])
+    os.environ['BENCH_RTF'] = str(bench_args.rtf)
+    os.environ['BENCH_CHARS_PER_SECOND'] = str(bench_args.chars_per_second)
+    os.environ['BENCH_PIPER_START'] = str(bench_args.piper_start)
+    os.environ['BENCH_FFMPEG_START'] = str(bench_args.ffmpeg_start)
+    os.environ['BENCH_XTTS_LOAD'] = str(bench_args.xtts_load)
+    os.environ['BENCH_XTTS_MB'] = str(bench_args.xtts_mb)
+
+def touch(path: str, content: str = ''):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if not os.path.exists(path):
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(content)
+
+def setup_workdir(work_dir: str):
+    # the default voice config, with empty stand-in files for every model and speaker sample it uses
+    config_dir = os.path.join(work_dir, 'config')
+    os.makedirs(config_dir)
+    shutil.copy(os.path.join(REPO_DIR, 'voice_to_speaker.default.yaml'), os.path.join(config_dir, 'voice_to_speaker.yaml'))
+    shutil.copy(os.path.join(REPO_DIR, 'pre_process_map.default.yaml'), os.path.join(config_dir, 'pre_process_map.yaml'))
+
+    with open(os.path.join(config_dir, 'voice_to_speaker.yaml'), 'r', encoding='utf8') as f:
+        voices = yaml.safe_load(f)
+
+    for conf in voices.get('tts-1', {}).values():
+        model = os.path.join(work_dir, str(conf.get('model', '')))
+        touch(model)
+        touch(f"{model}.json", json.dumps({ 'audio': { 'sample_rate': 22050 } }))
+
+    for conf in voices.get('tts-1-hd', {}).values():
+        speaker = os.path.join(work_dir, str(conf.get('speaker', '')))
+        touch(speaker if os.path.splitext(speaker)[1] else os.path.join(speaker, 'sample.wav'))
+        if conf.get('model_path'):
+            touch(os.path.join(work_dir, conf['model_path'], 'config.json'), '{}')
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def speech_request(port: int, body: dict) -> dict:
+    # a minimal http client, to time the first byte of the response without another dependency
+    data = json.dumps(body).encode('utf-8')
+    start = time.time()
+    result = { 'model': body['model'], 'voice': body['voice'], 'status': 0, 'ttfb': None, 'latency': None, 'bytes': 0 }
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'POST /v1/audio/speech HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                     + f'Content-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode('ascii') + data)
+        await writer.drain()
+
+        head = await reader.readuntil(b'\r\n\r\n')
+        result['status'] = int(head.split(b' ', 2)[1])
+        tail = b''
+        while chunk := await reader.read(65536):
+            if result['ttfb'] is None:
+                result['ttfb'] = time.time() - start
+            result['bytes'] += len(chunk)
+            tail = (tail + chunk)[-5:]
+        writer.close()
+
+        # a stream which fails after the headers were sent is cut off before the last chunk
+        if b'transfer-encoding: chunked' in head.lower() and tail != b'0\r\n\r\n':
+            result['error'] = 'incomplete response'
+        elif result['status'] == 200 and result['bytes'] <= len(b'0\r\n\r\n'):
+            result['error'] = 'empty response'
+    except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+        result['error'] = repr(e)
+
+    result['latency'] = time.time() - start
+    return result
+
+async def replay(port: int, requests: list, concurrency: int, rate: float) -> list:
+    slots = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def one(body):
+        try:
+            results.append(await speech_request(port, body))
+        finally:
+            slots.release()
+
+    tasks = []
+    start = time.time()
+    for i, body in enumerate(requests):
+        if rate > 0: # open loop, late requests are started right away
+            await asyncio.sleep(max(0, start + i / rate - time.time()))
+        await slots.acquire()
+        tasks.append(asyncio.create_task(one(body)))
+
+    await asyncio.gather(*tasks)
+    return results
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def p(q):
+        pos = (len(values) - 1) * q
+        low = int(pos)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (pos - low)
+
+    return { 'p50': round(p(0.50), 4), 'p95': round(p(0.95), 4), 'p99': round(p(0.99), 4), 'mean': round(sum(values) / len(values), 4), 'max': round(values[-1], 4) }
+
+def rtf_snapshot(metrics) -> dict:
+    with metrics.real_time_factor.lock:
+        return { key[0]: (counts[-1], total) for key, (counts, total) in metrics.real_time_factor.values.items() }
+
+def main(argv=None):
+    bench_args, server_argv = parse_args(argv)
+    mix = load_mix(bench_args.mix)
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='openedai-speech-bench-')
+    try:
+        install_fakes(bench_args, os.path.join(work_dir, 'fakes'))
+        setup_workdir(work_dir)
+        os.chdir(work_dir)
+        sys.path.insert(0, REPO_DIR)
+
+        import uvicorn
+        import speech
+        import metrics
+
+        port = free_port()
+        server_args = speech.parse_args(['--xtts_device', 'cpu', '-L', 'WARNING'] + server_argv + ['-H', '127.0.0.1', '-P', str(port)])
+        setup_start = time.time()
+        speech.setup_server(server_args)
+
+        server = uvicorn.Server(uvicorn.Config(speech.app, host='127.0.0.1', port=port, log_level='warning'))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            if not thread.is_alive():
+                raise RuntimeError("The server failed to start")
+            time.sleep(0.01)
+        startup = time.time() - setup_start
+        while any(state in ['starting', 'loading'] for state in speech.app.model_states().values()): # Ex. --preload
+            time.sleep(0.01)
+        ready = time.time() - setup_start
+
+        rng = random.Random(bench_args.seed)
+        weights = [entry.get('weight', 1) for entry in mix]
+        warmup_count = len(mix) if bench_args.warmup is None else bench_args.warmup
+        strip = lambda entry: { k: v for k, v in entry.items() if k != 'weight' }
+        requests = [strip(entry) for entry in rng.choices(mix, weights=weights, k=bench_args.requests)]
+        warmup = [strip(mix[i % len(mix)]) for i in range(warmup_count)]
+
+        asyncio.run(replay(port, warmup, bench_args.concurrency, 0))
+
+        before = rtf_snapshot(metrics)
+        start = time.time()
+        results = asyncio.run(replay(port, requests, bench_args.concurrency, bench_args.rate))
+        duration = time.time() - start
+        after = rtf_snapshot(metrics)
+
+        server.should_exit = True
+        thread.join()
+
+        ok = [r for r in results if r['status'] == 200 and r['ttfb'] is not None and 'error' not in r]
+        statuses = {}
+        for r in results:
+            statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+
+        rtf = {}
+        for model, (count, total) in after.items():
+            count -= before.get(model, (0, 0))[0]
+            total -= before.get(model, (0, 0))[1]
+            if count:
+                rtf[model] = round(total / count, 3)
+
+        by_model = {}
+        for model in sorted(set(r['model'] for r in ok)):
+            by_model[model] = { 'requests': sum(1 for r in ok if r['model'] == model), 'ttfb_seconds': percentiles([r['ttfb'] for r in ok if r['model'] == model]) }
+
+        report = {
+            'config': { **{ k: v for k, v in vars(bench_args).items() if k != 'output' }, 'server_args': server_argv },
+            'startup_seconds': round(startup, 3),
+            'ready_seconds': round(ready, 3),
+            'requests': len(results),
+            'errors': len(results) - len(ok),
+            'status': statuses,
+            'duration_seconds': round(duration, 3),
+            'throughput': {
+                'requests_per_second': round(len(ok) / duration, 3) if duration else 0,
+                'bytes_per_second': round(sum(r['bytes'] for r in ok) / duration) if duration else 0,
+            },
+            'ttfb_seconds': percentiles([r['ttfb'] for r in ok]),
+            'latency_seconds': percentiles([r['latency'] for r in ok]),
+            'rtf': rtf,
+            'models': by_model,
+            'peak_rss_mb': { # the client runs in the server process too
+                'server': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            },
+        }
+
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if bench_args.output:
+        with open(bench_args.output, 'w', encoding='utf8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
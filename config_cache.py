@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Config files are parsed once and reloaded only when they change, so they can still be edited without restarting the server.
+import json
+import os
+import threading
+import types
+
+import yaml
+from loguru import logger
+
+from preprocess_engine import preprocess_rules
+
+def default_exists(filename: str):
+    if not os.path.exists(filename):
+        fpath, ext = os.path.splitext(filename)
+        basename = os.path.basename(fpath)
+        default = f"{basename}.default{ext}"
+
+        logger.info(f"{filename} does not exist, setting defaults from {default}")
+
+        with open(default, 'r', encoding='utf8') as from_file:
+            with open(filename, 'w', encoding='utf8') as to_file:
+                to_file.write(from_file.read())
+
+class cached_file():
+    def __init__(self, filename: str, loader, default: bool = False):
+        self.filename = filename
+        self.loader = loader
+        self.default = default
+        self.mtime = None
+        self.value = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            if not self.default:
+                raise
+            default_exists(self.filename)
+            mtime = os.stat(self.filename).st_mtime_ns
+
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    with open(self.filename, 'r', encoding='utf8') as file:
+                        self.value = self.loader(file)
+                    self.mtime = mtime
+                    logger.debug(f"Loaded {self.filename}")
+
+        return self.value
+
+def load_pre_process_map(file) -> preprocess_rules:
+    return preprocess_rules(yaml.safe_load(file) or [])
+
+def load_voice_map(file) -> dict:
+    # voices are read only, callers that need to change a voice must make a copy
+    voice_map = yaml.safe_load(file) or {}
+    return types.MappingProxyType({
+        model: types.MappingProxyType({ voice: types.MappingProxyType(dict(conf or {})) for voice, conf in voices.items() })
+        for model, voices in voice_map.items()
+    })
+
+def load_prerender(file) -> list:
+    # groups of phrases x voices x formats (x speeds) -> speech requests, Ex.
+    # - model: tts-1
+    #   voice: [alloy, nova]
+    #   response_format: [mp3, wav]
+    #   input: [Please hold., Your call is important to us.]
+    requests = []
+    for group in yaml.safe_load(file) or []:
+        group = { field: value if isinstance(value, list) else [value] for field, value in group.items() }
+        for model in group.get('model', ['tts-1']):
+            for voice in group.get('voice', ['alloy']):
+                for response_format in group.get('response_format', ['mp3']):
+                    for speed in group.get('speed', [1.0]):
+                        for text in group.get('input', []):
+                            requests.append({ 'model': model, 'voice': voice, 'response_format': response_format, 'speed': speed, 'input': text })
+    return requests
+
+pre_process_map = cached_file('config/pre_process_map.yaml', load_pre_process_map, default=True)
+voice_to_speaker = cached_file('config/voice_to_speaker.yaml', load_voice_map, default=True)
+prerender_phrases = cached_file('config/prerender.yaml', load_prerender)
+
+piper_configs = {}
+
+def piper_sample_rate(piper_model: str) -> str:
+    try:
+        conf = piper_configs.setdefault(piper_model, cached_file(f"{piper_model}.json", json.load))
+        return str(conf.get()['audio']['sample_rate'])
+    except:
+        return '22050'
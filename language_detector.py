@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Language detection for xtts voices with 'language: auto'. Only the start of the text is looked at, the results
+# are memoized by a hash of it, and langdetect is seeded and limited to the xtts languages (or the voice's
+# 'languages:', with optional weights), so the same text always gets the same language and the same speech cache
+# entries. Text mostly in a script which only one of the languages uses (Ex. Hangul) doesn't need langdetect at all.
+import collections
+import hashlib
+import re
+import threading
+
+from loguru import logger
+
+import metrics
+
+XTTS_LANGUAGES = [
+    'en', 'es', 'fr', 'de', 'it', 'pt', 'pl', 'tr',
+    'ru', 'nl', 'cs', 'ar', 'zh-cn', 'hu', 'ko', 'ja', 'hi'
+]
+
+ALL_LANGUAGES = dict.fromkeys(XTTS_LANGUAGES, 1.0)
+
+LETTERS = re.compile(r'[^\W\d_]')
+
+# (script, language, also needs), in order. The text is in the script when most of its letters are, a few words
+# (Ex. 'I love 寿司') are left to langdetect. Japanese is kana and the chinese characters, with some kana.
+SCRIPTS = [
+    (re.compile('[\u3040-\u30ff\u4e00-\u9fff]'), 'ja', re.compile('[\u3040-\u30ff]')), # hiragana, katakana, kanji
+    (re.compile('[\u1100-\u11ff\uac00-\ud7af]'), 'ko', None), # hangul
+    (re.compile('[\u4e00-\u9fff]'), 'zh-cn', None),
+    (re.compile('[\u0600-\u06ff]'), 'ar', None),
+    (re.compile('[\u0900-\u097f]'), 'hi', None), # devanagari
+    (re.compile('[\u0400-\u04ff]'), 'ru', None), # cyrillic
+]
+
+def script_language(sample: str, priors: dict) -> str:
+    # the language of the script most of the letters are in, or None
+    letters = len(LETTERS.findall(sample))
+    for script, language, needs in SCRIPTS:
+        if language in priors and (needs is None or needs.search(sample)) and len(script.findall(sample)) * 2 > letters:
+            return language
+    return None
+
+class language_detector():
+    def __init__(self, max_chars: int = 200, cache_size: int = 4096, default: str = 'en', seed: int = 0):
+        self.max_chars = max_chars
+        self.cache_size = cache_size
+        self.default = default
+        self.seed = seed
+        self.cache = collections.OrderedDict() # hash of the sample and languages -> language
+        self.factory = None
+        self.lock = threading.Lock()
+
+    def _priors(self, languages) -> dict:
+        # a list of languages or a dict of language -> weight, limited to the xtts languages
+        if isinstance(languages, dict):
+            priors = { str(lang).lower(): float(weight) for lang, weight in languages.items() }
+        else:
+            priors = dict.fromkeys((str(lang).lower() for lang in languages), 1.0)
+
+        priors = { lang: weight for lang, weight in priors.items() if lang in XTTS_LANGUAGES and weight > 0 }
+        if not priors:
+            logger.warning(f"No supported languages in {languages}, using all the xtts languages")
+            priors = ALL_LANGUAGES
+        return priors
+
+    def load(self):
+        # the langdetect profiles take a moment to load, Ex. call it in the background at startup
+        with self.lock:
+            if self.factory is None:
+                from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+                factory = DetectorFactory()
+                factory.load_profile(PROFILES_DIRECTORY)
+                factory.set_seed(self.seed)
+                self.factory = factory
+
+    def _langdetect(self, sample: str, priors: dict) -> str:
+        if len(priors) == 1:
+            return next(iter(priors))
+
+        self.load()
+        detector = self.factory.create()
+        detector.set_max_text_length(self.max_chars)
+        detector.set_prior_map(priors) # 0 for the other languages, so they are never picked
+        detector.append(sample)
+        language = detector.detect()
+        return language if language in priors else self.default
+
+    def detect(self, text: str, languages=None) -> str:
+        sample = text[:self.max_chars]
+        if languages:
+            priors = self._priors(languages)
+            key = hashlib.blake2b(f"{sorted(priors.items())}\0{sample}".encode('utf-8'), digest_size=16).digest()
+        else:
+            priors = ALL_LANGUAGES
+            key = hashlib.blake2b(sample.encode('utf-8'), digest_size=16).digest()
+
+        with self.lock:
+            language = self.cache.get(key)
+            if language is not None:
+                self.cache.move_to_end(key)
+                metrics.cache_requests.inc(cache='language', result='hit')
+                return language
+        metrics.cache_requests.inc(cache='language', result='miss')
+
+        language = script_language(sample, priors)
+        if language is None:
+            try:
+                language = self._langdetect(sample, priors)
+            except Exception as e: # Ex. no letters in the text
+                logger.debug(f"Failed to detect language, defaulting to {self.default}: {repr(e)}")
+                language = self.default
+
+        with self.lock:
+            self.cache[key] = language
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return language
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Prometheus metrics for the synthesis pipeline, served as text on /metrics. This is a small subset of
+# prometheus_client (counters, gauges and histograms with labels), so it doesn't need another dependency.
+import asyncio
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+metrics = [] # every metric, in the order they are defined
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class metric():
+    type: str = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: list = []):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {} # label values -> value
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+class counter(metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class gauge(metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+class histogram(metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: list = [], buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        return _timer(self, labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    le = 'le="' + _number(bound) + '"'
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+class _timer():
+    # with histogram.time(label=...): observes the time spent in the block
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+def render() -> str:
+    lines = []
+    for m in metrics:
+        lines.extend(m.render())
+    return '\n'.join(lines) + '\n'
+
+# The pipeline metrics
+ttfb = histogram('tts_time_to_first_byte_seconds', "Time from the request to the first byte of audio", ['model', 'voice'])
+synthesis_seconds = histogram('tts_synthesis_seconds', "Time to generate and encode a whole response", ['model', 'voice'])
+real_time_factor = histogram('tts_real_time_factor', "Seconds of audio generated per second of wall time", ['model'], buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+chunks_per_second = histogram('tts_chunks_per_second', "Audio chunks generated per second", ['model'], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+tokens_per_second = histogram('xtts_tokens_per_second', "xtts GPT tokens generated per second (estimated from the chunks without batching)", ['model'], buckets=(5, 10, 20, 50, 100, 200, 500, 1000))
+lock_wait = histogram('xtts_lock_wait_seconds', "Time a sentence waited for the xtts model (lock or batch queue)", ['model'])
+spawn_seconds = histogram('process_spawn_seconds', "Time to start a piper or ffmpeg process", ['process'])
+active_streams = gauge('tts_active_streams', "Responses being streamed", ['model'])
+model_load_seconds = histogram('model_load_seconds', "Time to load a model", ['engine', 'model'], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+model_unload_seconds = histogram('model_unload_seconds', "Time to unload a model", ['engine', 'model', 'reason'])
+cache_requests = counter('cache_requests_total', "Cache lookups by cache and result (hit, disk or miss)", ['cache', 'result'])
+admission_queue = gauge('admission_queue_length', "Requests waiting for their turn to generate", ['model'])
+admission_rejected = counter('admission_rejected_total', "Requests turned away with a 429 by reason (queue full, timeout or preempted by a higher priority)", ['model', 'reason'])
+
+class stream_meter():
+    # Measures one response: the pcm going into the encoder and the encoded bytes going out.
+    def __init__(self, model: str, voice: str, bytes_per_second: int, start: float = None, trace=None):
+        self.model = model
+        self.voice = voice
+        self.bytes_per_second = bytes_per_second
+        self.start = start or time.time()
+        self.trace = trace # a tracing.request_trace, finished when the response is done
+        self.audio_bytes = 0
+        self.chunks = 0
+
+    async def pcm(self, pcm_iter):
+        try:
+            async for chunk in pcm_iter:
+                if self.trace and not self.chunks:
+                    self.trace.mark('first_pcm')
+                self.audio_bytes += len(chunk)
+                self.chunks += 1
+                yield chunk
+            if self.trace:
+                self.trace.mark('last_pcm')
+        finally:
+            await pcm_iter.aclose()
+
+    async def content(self, content):
+        active_streams.inc(model=self.model)
+        first = True
+        status = 'error'
+        try:
+            async for chunk in content:
+                if first:
+                    ttfb.observe(time.time() - self.start, model=self.model, voice=self.voice)
+                    if self.trace:
+                        self.trace.mark('first_byte')
+                    first = False
+                yield chunk
+
+            elapsed = time.time() - self.start
+            synthesis_seconds.observe(elapsed, model=self.model, voice=self.voice)
+            if elapsed > 0 and self.audio_bytes:
+                real_time_factor.observe(self.audio_bytes / self.bytes_per_second / elapsed, model=self.model)
+                chunks_per_second.observe(self.chunks / elapsed, model=self.model)
+            status = 'ok'
+
+        except (GeneratorExit, asyncio.CancelledError): # client disconnect
+            status = 'disconnected'
+            raise
+
+        finally:
+            active_streams.dec(model=self.model)
+            await content.aclose()
+            if self.trace:
+                self.trace.mark('last_byte')
+                self.trace.finish(status, audio_seconds=round(self.audio_bytes / self.bytes_per_second, 2), chunks=self.chunks)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# Loaded models, up to a memory budget. The least recently used idle models are unloaded first, and models
+# are loaded in their own thread so requests for models which are already loaded keep being served.
+#
+# A model object needs .size() in bytes and .unload(). Requests hold a lease on the model while they use it, from
+# lease_async(), which loads it if needed.
+#
+# With an idle timeout each loaded model has one timer, set to when it would become idle. When it fires it
+# either unloads the model or moves to the new deadline if the model was used since, so it runs at most once
+# per timeout and never waits for generation. Models unloaded this way can be loaded again in the background
+# with wake(), Ex. when requests start coming in again, or at set times of the day.
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import threading
+import time
+
+from loguru import logger
+
+import metrics
+
+class model_lease():
+    # keeps a model loaded until release(), or until the request that holds it is gone
+    def __init__(self, registry, model):
+        self.registry = registry
+        self.model = model
+        registry._acquire(model)
+
+    def release(self):
+        if self.registry:
+            self.registry._release(self.model)
+            self.registry = None
+
+    __del__ = release
+
+class model_registry():
+    def __init__(self, load, max_mb: int = 0, idle_timeout: int = None, name: str = 'model', label=str):
+        self.load = load # (key, version) -> model
+        self.name = name # for the metrics
+        self.label = label # key -> model name for the metrics
+        self.max_bytes = max_mb * 1024 * 1024 # 0 keeps only the most recently used model
+        self.idle_timeout = idle_timeout
+        self.models = collections.OrderedDict() # key -> (model, version)
+        self.loading = {} # key -> (future, version)
+        self.sizes = {} # key -> size of the last load, to make room before loading it again
+        self.users = collections.Counter() # model -> requests using it
+        self.last_used = {} # key -> time
+        self.timers = {} # key -> idle timer
+        self.known = {} # key -> version, every model that was requested
+        self.idle_unloaded = {} # key -> version, for wake()
+        self.wake_timer = None
+        self.lock = threading.RLock() # a lease can be released by the garbage collector while the lock is held
+
+    def size(self) -> int:
+        return sum(model.size() for model, _ in self.models.values())
+
+    def busy(self, model) -> bool:
+        return self.users[model] > 0
+
+    def _key(self, model):
+        return next((key for key, (m, _) in self.models.items() if m is model), None)
+
+    def _touch(self, model):
+        key = self._key(model)
+        if key is not None:
+            self.last_used[key] = time.time()
+
+    def _acquire(self, model):
+        with self.lock:
+            self.users[model] += 1
+            self._touch(model)
+
+    def _release(self, model):
+        with self.lock:
+            self._touch(model)
+            self.users[model] -= 1
+            if self.users[model] > 0:
+                return
+            del self.users[model]
+            # a newer model may have been loaded while this one was in use, checked before evicting, which can
+            # unload this one too
+            replaced = [(getattr(model, 'key', None), model)] if all(m is not model for m, _ in self.models.values()) else []
+            keep = next(reversed(self.models), None)
+            evicted = self._evict(keep=keep)
+
+        self._unload(evicted)
+        self._unload(replaced, reason='replaced')
+
+    def _arm(self, key, delay: float):
+        # with self.lock held
+        if not self.idle_timeout or key in self.timers:
+            return
+        timer = threading.Timer(delay, self._check_idle, args=(key,))
+        timer.daemon = True
+        timer.start()
+        self.timers[key] = timer
+
+    def _check_idle(self, key):
+        with self.lock:
+            self.timers.pop(key, None)
+            if key not in self.models:
+                return
+
+            model, version = self.models[key]
+            deadline = self.last_used.get(key, 0) + self.idle_timeout
+            if self.busy(model): # checked again after the timeout, the deadline moves when it's released
+                self._arm(key, self.idle_timeout)
+                return
+            if time.time() < deadline:
+                self._arm(key, deadline - time.time())
+                return
+
+            del self.models[key]
+            self.idle_unloaded[key] = version
+
+        logger.info(f"Model {key} idle for {self.idle_timeout}s")
+        self._unload([(key, model)], reason='idle')
+
+    def _evict(self, keep, needed: int = 0):
+        # with self.lock held, returns the evicted models, unload them after releasing the lock
+        evicted = []
+        for key in list(self.models):
+            if self.max_bytes and self.size() + needed <= self.max_bytes:
+                break
+            model, _ = self.models[key]
+            if key == keep or self.busy(model):
+                continue
+            del self.models[key]
+            evicted.append((key, model))
+        return evicted
+
+    def _forget(self, key):
+        # with self.lock held, after a model was removed
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+
+    def _unload(self, evicted: list, reason: str = 'evicted'):
+        with self.lock:
+            for key, _ in evicted:
+                if key not in self.models:
+                    self._forget(key)
+
+        for key, model in evicted:
+            if self.busy(model): # replaced while still in use, it's freed when the last request is done with it
+                logger.info(f"Dropping model {key}")
+                continue
+            logger.info(f"Unloading model {key}")
+            try:
+                with metrics.model_unload_seconds.time(engine=self.name, model=self.label(key), reason=reason):
+                    model.unload()
+            except Exception as e:
+                logger.error(f"Failed to unload {key}: {repr(e)}")
+
+        if evicted:
+            free_memory()
+
+    def _load(self, key, version, future):
+        start = time.time()
+        try:
+            model = self.load(key, version)
+        except BaseException as e:
+            with self.lock:
+                self.loading.pop(key, None)
+            future.set_exception(e)
+            return
+
+        with self.lock:
+            self.models[key] = (model, version)
+            self.sizes[key] = model.size()
+            self.loading.pop(key, None)
+            self.last_used[key] = time.time()
+            self._arm(key, self.idle_timeout)
+            evicted = self._evict(keep=key)
+
+        self._unload(evicted)
+        metrics.model_load_seconds.observe(time.time() - start, engine=self.name, model=self.label(key))
+        logger.info(f"Loaded model {key} in {time.time() - start:.2f}s ({model.size() / 1024 / 1024:.0f}MB, {len(self.models)} loaded)")
+        future.set_result(model)
+
+    def request(self, key, version=None) -> concurrent.futures.Future:
+        # the loaded model, or a future for it. A new version of a loaded model (Ex. a retrained checkpoint) replaces it.
+        replaced = []
+        with self.lock:
+            self.known[key] = version
+            self.idle_unloaded.pop(key, None)
+            if key in self.models:
+                model, loaded_version = self.models[key]
+                if loaded_version == version:
+                    self.models.move_to_end(key)
+                    future = concurrent.futures.Future()
+                    future.set_result(model)
+                    return future
+
+                logger.info(f"Model {key} changed, reloading")
+                del self.models[key]
+                replaced.append((key, model))
+
+            if key in self.loading and self.loading[key][1] == version:
+                return self.loading[key][0]
+
+            # make room first, GPU memory usually can't hold the old and the new model at the same time
+            needed = self.sizes.get(key, max(self.sizes.values(), default=0))
+            evicted = self._evict(keep=None, needed=needed)
+
+            future = concurrent.futures.Future()
+            self.loading[key] = (future, version)
+
+        self._unload(replaced, reason='replaced')
+        self._unload(evicted)
+        threading.Thread(target=self._load, args=(key, version, future), daemon=True).start()
+        return future
+
+    def get(self, key, version=None):
+        return self.request(key, version).result()
+
+    async def get_async(self, key, version=None):
+        return await asyncio.wrap_future(self.request(key, version))
+
+    def lease(self, model) -> model_lease:
+        return model_lease(self, model)
+
+    async def lease_async(self, key, version=None) -> model_lease:
+        # The model, loaded if needed, with the lease taken under the lock, so it can't be unloaded (idle or evicted)
+        # between the load and the lease. Loaded again if it was unloaded before the lease could be taken.
+        while True:
+            with self.lock:
+                model, loaded_version = self.models.get(key, (None, None))
+                if model is not None and loaded_version == version:
+                    self.known[key] = version
+                    self.idle_unloaded.pop(key, None)
+                    self.models.move_to_end(key)
+                    return model_lease(self, model)
+            await asyncio.wrap_future(self.request(key, version))
+
+    def unload(self, key) -> bool:
+        # unload an idle model, Ex. after the unload timer
+        with self.lock:
+            model, _ = self.models.get(key, (None, None))
+            if model is None or self.busy(model):
+                return False
+            del self.models[key]
+
+        self._unload([(key, model)], reason='unload')
+        return True
+
+    def unload_all(self):
+        with self.lock:
+            evicted = [(key, model) for key, (model, _) in self.models.items()]
+            self.models.clear()
+            if self.wake_timer:
+                self.wake_timer.cancel()
+
+        self._unload(evicted, reason='shutdown')
+
+    def wake(self):
+        # load the models which were unloaded for being idle in the background, if they fit without unloading others
+        with self.lock:
+            if not self.idle_unloaded:
+                return
+            waking = []
+            for key, version in list(self.idle_unloaded.items()):
+                if self.max_bytes:
+                    fits = self.size() + sum(self.sizes.get(k, 0) for k, _ in waking) + self.sizes.get(key, 0) <= self.max_bytes
+                else:
+                    fits = not self.models and not self.loading and not waking
+                if not fits:
+                    continue
+                del self.idle_unloaded[key]
+                waking.append((key, version))
+
+        for key, version in waking:
+            logger.info(f"Reloading model {key}")
+            self.request(key, version)
+
+    def wake_at(self, times: list):
+        # wake() every day at these local times, Ex. ['07:30', '13:00']
+        now = datetime.datetime.now()
+        upcoming = []
+        for t in times:
+            hour, minute = map(int, t.split(':'))
+            at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if at <= now:
+                at += datetime.timedelta(days=1)
+            upcoming.append(at)
+
+        def wake_and_reschedule():
+            self.wake()
+            self.wake_at(times)
+
+        self.wake_timer = threading.Timer((min(upcoming) - now).total_seconds(), wake_and_reschedule)
+        self.wake_timer.daemon = True
+        self.wake_timer.start()
+
+    def status(self) -> list:
+        # [(key, { 'state': 'loaded' | 'loading' | 'unloaded', ... })] for every model that was requested
+        now = time.time()
+        with self.lock:
+            result = []
+            for key in self.known:
+                if key in self.models:
+                    model, _ = self.models[key]
+                    info = { 'state': 'loaded', 'size_mb': round(model.size() / 1024 / 1024), 'requests': self.users[model], 'idle_seconds': round(now - self.last_used.get(key, now)) }
+                elif key in self.loading:
+                    info = { 'state': 'loading' }
+                else:
+                    info = { 'state': 'unloaded' }
+                result.append((key, info))
+            return result
+
+def free_memory():
+    import gc
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+    except ImportError:
+        pass
@@ -1,8 +1,11 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse, JSONResponse
+from starlette.datastructures import Headers
 from loguru import logger
 
+import metrics
+
 class OpenAIError(Exception):
     pass
 
@@ -11,6 +14,7 @@ class APIError(OpenAIError):
     code: str = None
     param: str = None
     type: str = None
+    headers: dict = None
 
     def __init__(self, message: str, code: int = 500, param: str = None, internal_message: str = ''):
         super().__init__(message)
@@ -62,10 +66,46 @@ class UnprocessableEntityError(APIStatusError):
 class RateLimitError(APIStatusError):
     status_code: int = 429
 
+    def __init__(self, message: str, param: str = None, internal_message: str = '', retry_after: int = None):
+        super().__init__(message, param, internal_message)
+        if retry_after is not None:
+            self.headers = { 'Retry-After': str(retry_after) }
+
+class log_requests():
+    # Logs requests and responses at debug level. The body is logged as it's read by the endpoint. Only added with
+    # debug logging (Ex. --log-level DEBUG), so otherwise requests don't go through it at all.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        logger.debug(f"Request path: {scope['path']}")
+        logger.debug(f"Request method: {scope['method']}")
+        logger.debug(f"Request headers: {Headers(scope=scope)}")
+        logger.debug(f"Request query params: {scope['query_string'].decode('latin-1')}")
+
+        async def logged_receive():
+            message = await receive()
+            if message['type'] == 'http.request':
+                logger.debug(f"Request body: {message.get('body', b'')}")
+            return message
+
+        async def logged_send(message):
+            if message['type'] == 'http.response.start':
+                logger.debug(f"Response status code: {message['status']}")
+                logger.debug(f"Response headers: {Headers(raw=message.get('headers', []))}")
+            await send(message)
+
+        await self.app(scope, logged_receive, logged_send)
+
 class OpenAIStub(FastAPI):
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
         self.models = {}
+        self.status = {} # name -> function returning extra model info, Ex. if it's loaded
+        self.states = {} # name -> 'starting', 'loading', 'ready' or 'failed', models without one are ready
 
         self.add_middleware(
             CORSMiddleware,
@@ -93,7 +133,7 @@ class OpenAIStub(FastAPI):
             if exc.internal_message:
                 logger.info(exc.internal_message)
 
-            return JSONResponse(status_code = exc.code, content={
+            return JSONResponse(status_code = exc.code, headers=exc.headers, content={
                 'message': exc.message,
                 'code': exc.code,
                 'type': exc.__class__.__name__,
@@ -108,28 +148,13 @@ class OpenAIStub(FastAPI):
             if exc.internal_message:
                 logger.info(exc.internal_message)
 
-            return JSONResponse(status_code = exc.code, content={
+            return JSONResponse(status_code = exc.code, headers=exc.headers, content={
                 'message': exc.message,
                 'code': exc.code,
                 'type': exc.__class__.__name__,
                 'param': exc.param,
             })
 
-        @self.middleware("http")
-        async def log_requests(request: Request, call_next):
-            logger.debug(f"Request path: {request.url.path}")
-            logger.debug(f"Request method: {request.method}")
-            logger.debug(f"Request headers: {request.headers}")
-            logger.debug(f"Request query params: {request.query_params}")
-            logger.debug(f"Request body: {await request.body()}")
-
-            response = await call_next(request)
-
-            logger.debug(f"Response status code: {response.status_code}")
-            logger.debug(f"Response headers: {response.headers}")
-
-            return response
-
         @self.get('/v1/billing/usage')
         @self.get('/v1/dashboard/billing/usage')
         async def handle_billing_usage():
@@ -139,22 +164,39 @@ class OpenAIStub(FastAPI):
         @self.head("/", response_class=PlainTextResponse)
         @self.options("/", response_class=PlainTextResponse)
         async def root():
-            return PlainTextResponse(content="", status_code=200 if self.models else 503)
+            # 200 as soon as one model can be used
+            return PlainTextResponse(content="", status_code=200 if 'ready' in self.model_states().values() else 503)
 
         @self.get("/health")
         async def health():
-            return {"status": "ok" if self.models else "unk" }
+            states = self.model_states()
+            if not states:
+                return {"status": "unk" }
+            status = next((state for state in ['starting', 'loading', 'failed'] if state in states.values()), "ok")
+            return {"status": status, "models": states }
+
+        @self.get("/metrics", response_class=PlainTextResponse)
+        async def get_metrics():
+            return PlainTextResponse(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
         @self.get("/v1/models")
         async def get_model_list():
             return self.model_list()
 
         @self.get("/v1/models/{model}")
-        async def get_model_info(model_id: str):
-            return self.model_info(model_id)
+        async def get_model_info(model: str):
+            return self.model_info(model)
 
-    def register_model(self, name: str, model: str = None) -> None:
+    def register_model(self, name: str, model: str = None, status = None) -> None:
         self.models[name] = model if model else name
+        if status:
+            self.status[name] = status
+
+    def set_state(self, name: str, state: str) -> None:
+        self.states[name] = state
+
+    def model_states(self) -> dict:
+        return { name: self.states.get(name, 'ready') for name in self.models }
 
     def deregister_model(self, name: str) -> None:
         if name in self.models:
@@ -167,6 +209,8 @@ class OpenAIStub(FastAPI):
             "created": 0,
             "owned_by": "user"
         }
+        if model in self.status:
+            result.update(self.status[model]())
         return result
 
     def model_list(self) -> dict:
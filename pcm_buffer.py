@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Bounded pcm buffering between generation (in a thread) and the encoder (in the event loop).
+#
+# The pcm is copied straight from the generated arrays (through a memoryview, without .tobytes()) into frames
+# from a pool of preallocated frames shared by all the streams. A stream can hold at most max_bytes of frames,
+# and all the streams together at most the pool, so a slow client makes its generation wait instead of the
+# buffered pcm growing, and memory stays flat with many slow clients.
+import asyncio
+import collections
+import mmap
+import threading
+
+class pcm_frames():
+    # the global memory cap, all the frames are allocated up front as views of one anonymous mmap (the os only
+    # commits the memory as the frames are first written) and reused after that
+    def __init__(self, max_mb: int = 256, frame_kb: int = 64):
+        self.frame_bytes = frame_kb * 1024
+        self.max_frames = max(1, max_mb * 1024 * 1024 // self.frame_bytes)
+        self.arena = memoryview(mmap.mmap(-1, self.max_frames * self.frame_bytes))
+        self.free = [self.arena[i * self.frame_bytes:(i + 1) * self.frame_bytes] for i in range(self.max_frames)]
+        self.cond = threading.Condition()
+
+    def in_use(self) -> int:
+        with self.cond:
+            return self.max_frames - len(self.free)
+
+    def _take(self):
+        # with self.cond held, a free frame or None
+        return self.free.pop() if self.free else None
+
+    def give(self, frame: memoryview):
+        with self.cond:
+            self.free.append(frame)
+            self.cond.notify_all()
+
+    async def stream(self, sync_iter, max_bytes: int = 8 * 1024 * 1024):
+        # Runs a blocking pcm iterator (arrays or bytes) in its own thread like threaded_iter(), and yields the pcm
+        # as bytes. The thread waits while the stream has max_bytes buffered or the pool is used up.
+        loop = asyncio.get_running_loop()
+        max_frames = max(1, max_bytes // self.frame_bytes)
+        filled = collections.deque() # (frame, length), the end is (None, exception)
+        ready = asyncio.Event()
+        cancelled = threading.Event()
+
+        def push(frame, length):
+            with self.cond:
+                filled.append((frame, length))
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError: # event loop is closed
+                cancelled.set()
+
+        def write(chunk):
+            view = memoryview(chunk)
+            if not view.c_contiguous:
+                view = memoryview(bytes(view))
+            view = view.cast('B')
+            offset = 0
+            while offset < len(view):
+                with self.cond:
+                    while True:
+                        if cancelled.is_set():
+                            return False
+                        frame = self._take() if len(filled) < max_frames else None
+                        if frame is not None:
+                            break
+                        self.cond.wait(0.1)
+                length = min(len(frame), len(view) - offset)
+                frame[:length] = view[offset:offset + length]
+                offset += length
+                push(frame, length)
+            return True
+
+        def run():
+            try:
+                for chunk in sync_iter:
+                    if not write(chunk):
+                        return
+                push(None, None)
+
+            except BaseException as e:
+                push(None, e)
+
+            finally:
+                if hasattr(sync_iter, 'close'):
+                    sync_iter.close()
+
+        threading.Thread(target=run, daemon=True).start()
+
+        try:
+            while True:
+                with self.cond:
+                    frame, length = filled.popleft() if filled else (False, None)
+                if frame is False:
+                    ready.clear()
+                    if not filled: # checked again, the thread could have pushed in between
+                        await ready.wait()
+                    continue
+                if frame is None:
+                    if length is not None:
+                        raise length
+                    return
+                data = bytes(frame[:length]) # the only copy, frames are views
+                self.give(frame)
+                yield data
+        finally:
+            cancelled.set()
+            with self.cond:
+                while filled:
+                    frame, _ = filled.popleft()
+                    if frame:
+                        self.free.append(frame)
+                self.cond.notify_all()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# Long lived piper voices for tts-1, so a request doesn't pay for starting piper and loading the onnx model every time.
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+
+from loguru import logger
+
+import metrics
+
+WARMUP_TEXT = "Warm up."
+
+# espeak-ng isn't thread safe, and piper sets its (process global) voice before each phonemization, so voices
+# used from several threads at once would phonemize in each other's language. Only the phonemization is
+# serialized, the onnx inference still runs in parallel.
+phonemize_lock = threading.Lock()
+SENTENCE_END = re.compile(r'(?<=[.!?\u3002\uff01\uff1f])\s+|\n+')
+
+def load_piper_voice(model: str, intra_op_threads: int = None):
+    import onnxruntime
+    from piper import PiperVoice
+    from piper.config import PiperConfig
+
+    with open(f"{model}.json", 'r', encoding='utf8') as config_file:
+        config = json.load(config_file)
+
+    sess_options = onnxruntime.SessionOptions()
+    if intra_op_threads:
+        sess_options.intra_op_num_threads = intra_op_threads
+
+    session = onnxruntime.InferenceSession(str(model), sess_options=sess_options, providers=["CPUExecutionProvider"])
+
+    voice = PiperVoice(session=session, config=PiperConfig.from_dict(config))
+
+    phonemize = getattr(voice, 'phonemize', None)
+    if phonemize:
+        def locked_phonemize(text: str):
+            with phonemize_lock:
+                return phonemize(text)
+        voice.phonemize = locked_phonemize
+    return voice
+
+def piper_synthesize(voice, text: str, speaker=None, length_scale=None):
+    # yields raw s16le pcm, one chunk per sentence
+    speaker_id = int(speaker) if speaker is not None else None
+
+    if hasattr(voice, 'synthesize_stream_raw'): # piper-tts < 1.3
+        yield from voice.synthesize_stream_raw(text, speaker_id=speaker_id, length_scale=length_scale)
+    else:
+        from piper import SynthesisConfig
+        for chunk in voice.synthesize(text, SynthesisConfig(speaker_id=speaker_id, length_scale=length_scale)):
+            yield chunk.audio_int16_bytes
+
+def _worker_main(model: str, speaker, intra_op_threads, conn):
+    # Runs in the worker process: ('tts', text, length_scale) -> ('pcm', bytes)... ('done',) | ('error', str)
+    try:
+        voice = load_piper_voice(model, intra_op_threads)
+        for _ in piper_synthesize(voice, WARMUP_TEXT, speaker):
+            pass
+        conn.send(('ready', voice.config.sample_rate))
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        return
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if msg is None:
+            break
+
+        _, text, length_scale = msg
+        try:
+            for pcm in piper_synthesize(voice, text, speaker, length_scale):
+                conn.send(('pcm', pcm))
+            conn.send(('done',))
+        except Exception as e:
+            conn.send(('error', repr(e)))
+
+class piper_worker():
+    def __init__(self, model: str, speaker=None, intra_op_threads: int = None):
+        self.model = model
+        self.speaker = speaker
+        self.intra_op_threads = intra_op_threads
+        self.proc = None
+        self.conn = None
+        self.sample_rate = None
+        self.start()
+
+    def start(self):
+        start = time.time()
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker_main, args=(self.model, self.speaker, self.intra_op_threads, child_conn), daemon=True)
+        self.proc.start()
+        child_conn.close()
+
+        msg = self.conn.recv()
+        if msg[0] != 'ready':
+            self.stop()
+            raise RuntimeError(f"piper worker for {self.model} failed to start: {msg[1]}")
+
+        self.sample_rate = msg[1]
+        metrics.spawn_seconds.observe(time.time() - start, process='piper_worker')
+        logger.debug(f"piper worker ready: {self.model} speaker={self.speaker} pid={self.proc.pid}")
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.proc.join(timeout=1)
+        if self.proc.is_alive():
+            self.proc.kill()
+        self.conn.close()
+
+    def restart(self):
+        logger.warning(f"Restarting piper worker: {self.model} speaker={self.speaker}")
+        self.stop()
+        self.start()
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.is_alive()
+
+    def synthesize(self, text: str, length_scale=None):
+        self.conn.send(('tts', text, length_scale))
+        while True:
+            msg = self.conn.recv()
+            if msg[0] == 'pcm':
+                yield msg[1]
+            elif msg[0] == 'done':
+                return
+            else:
+                raise RuntimeError(f"piper worker error: {msg[1]}")
+
+class piper_pool():
+    check_interval: int = 5
+
+    def __init__(self, workers_per_voice: int = 1, intra_op_threads: int = None, wait_seconds: float = 60):
+        self.workers_per_voice = workers_per_voice
+        self.intra_op_threads = intra_op_threads
+        self.wait_seconds = wait_seconds # for an idle worker, before the request fails
+        self.pools = {} # (model, speaker) -> queue of idle workers, only once they have all started
+        self.workers = {} # (model, speaker) -> all workers
+        self.starting = {} # (model, speaker) -> lock
+        self.lock = threading.Lock()
+
+        self.timer = threading.Timer(self.check_interval, self.check_health)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def warmup(self, model: str, speaker=None, workers: int = None):
+        key = (model, speaker)
+        count = workers if workers else self.workers_per_voice
+
+        with self.lock:
+            if key in self.pools:
+                return
+            start_lock = self.starting.setdefault(key, threading.Lock())
+
+        with start_lock: # concurrent requests for the same voice wait for one start
+            if key in self.pools:
+                return
+
+            start = time.time()
+            started = []
+            try:
+                for _ in range(count):
+                    started.append(piper_worker(model, speaker, self.intra_op_threads))
+            except Exception:
+                # nothing is registered, so the next request tries again instead of waiting on an empty pool
+                for w in started:
+                    w.stop()
+                raise
+
+            pool = queue.Queue()
+            for w in started:
+                pool.put(w)
+            with self.lock:
+                self.workers[key] = started
+                self.pools[key] = pool
+                self.starting.pop(key, None)
+
+        logger.info(f"Started {count} piper worker(s) for {model} speaker={speaker} in {time.time() - start:.2f}s")
+
+    def check_health(self):
+        # restart idle workers which have crashed, busy workers are checked when they are used.
+        for key, pool in list(self.pools.items()):
+            idle = []
+            try:
+                while True:
+                    idle.append(pool.get_nowait())
+            except queue.Empty:
+                pass
+
+            for w in idle:
+                if not w.is_alive():
+                    try:
+                        w.restart()
+                    except Exception as e:
+                        logger.error(f"piper worker restart failed: {repr(e)}")
+                pool.put(w)
+
+        self.timer = threading.Timer(self.check_interval, self.check_health)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def synthesize(self, model: str, speaker, text: str, length_scale=None):
+        key = (model, speaker)
+        if key not in self.pools:
+            self.warmup(model, speaker)
+
+        try:
+            w = self.pools[key].get(timeout=self.wait_seconds)
+        except queue.Empty:
+            raise RuntimeError(f"No piper worker for {model} speaker={speaker} was free after {self.wait_seconds}s")
+
+        try:
+            if not w.is_alive():
+                w.restart()
+            yield from w.synthesize(text, length_scale)
+
+        except (EOFError, BrokenPipeError, ConnectionResetError, OSError) as e:
+            logger.error(f"piper worker crashed: {repr(e)}")
+            w.restart()
+            raise
+
+        except GeneratorExit:
+            # client went away mid stream, the worker pipe still has pcm in it, so start fresh
+            w.restart()
+            raise
+
+        finally:
+            self.pools[key].put(w)
+
+    def shutdown(self):
+        self.timer.cancel()
+        for workers in self.workers.values():
+            for w in workers:
+                w.stop()
+
+class piper_session_cache():
+    # One onnx session per model file, shared by every speaker and request. The least recently
+    # used sessions are dropped when the estimated size (the .onnx file size) is over the budget.
+    def __init__(self, max_mb: int = 1024, intra_op_threads: int = None):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.intra_op_threads = intra_op_threads
+        self.voices = collections.OrderedDict() # model -> (voice, size)
+        self.loading = {} # model -> lock
+        self.lock = threading.Lock()
+
+    def size(self) -> int:
+        return sum(size for _, size in self.voices.values())
+
+    def get(self, model: str):
+        with self.lock:
+            if model in self.voices:
+                self.voices.move_to_end(model)
+                metrics.cache_requests.inc(cache='piper_model', result='hit')
+                return self.voices[model][0]
+            load_lock = self.loading.setdefault(model, threading.Lock())
+
+        metrics.cache_requests.inc(cache='piper_model', result='miss')
+
+        with load_lock: # concurrent requests for the same model wait for one load
+            with self.lock:
+                if model in self.voices:
+                    self.voices.move_to_end(model)
+                    return self.voices[model][0]
+
+            start = time.time()
+            voice = load_piper_voice(model, self.intra_op_threads)
+            size = os.path.getsize(model)
+            metrics.model_load_seconds.observe(time.time() - start, engine='piper', model=os.path.basename(model))
+            logger.info(f"Loaded piper model {model} in {time.time() - start:.2f}s")
+
+            with self.lock:
+                self.voices[model] = (voice, size)
+                self.loading.pop(model, None)
+
+                while self.size() > self.max_bytes and len(self.voices) > 1:
+                    evicted, _ = self.voices.popitem(last=False)
+                    metrics.model_unload_seconds.observe(0, engine='piper', model=os.path.basename(evicted), reason='evicted')
+                    logger.info(f"Unloaded piper model {evicted}")
+
+        return voice
+
+    def synthesize(self, model: str, speaker, text: str, length_scale=None):
+        voice = self.get(model)
+        yield from piper_synthesize(voice, text, speaker, length_scale)
+
+def split_sentences(text: str, min_chars: int = 80) -> list[str]:
+    # short sentences are joined to the next one, so each piece is worth a separate synthesis
+    pieces = []
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if pieces and len(pieces[-1]) < min_chars:
+            pieces[-1] += ' ' + sentence
+        else:
+            pieces.append(sentence)
+    return pieces
+
+class piper_parallel():
+    # Long inputs are split into sentences, and up to `parallel` sentences are synthesized at the same
+    # time by the wrapped engine (piper_pool or piper_session_cache). The pcm is still returned in order,
+    # each sentence as soon as it and the ones before it are done.
+    def __init__(self, engine, parallel: int = 2, max_threads: int = None):
+        self.engine = engine
+        self.parallel = parallel
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads or parallel * 4, thread_name_prefix='piper')
+
+    def _synthesize_all(self, model: str, speaker, text: str, length_scale=None) -> bytes:
+        return b''.join(self.engine.synthesize(model, speaker, text, length_scale))
+
+    def synthesize(self, model: str, speaker, text: str, length_scale=None):
+        sentences = split_sentences(text)
+        if len(sentences) < 2:
+            yield from self.engine.synthesize(model, speaker, text, length_scale)
+            return
+
+        pending = iter(sentences)
+        running = collections.deque()
+        try:
+            for sentence in pending:
+                running.append(self.executor.submit(self._synthesize_all, model, speaker, sentence, length_scale))
+                if len(running) >= self.parallel:
+                    break
+
+            while running:
+                pcm = running.popleft().result()
+                sentence = next(pending, None)
+                if sentence is not None:
+                    running.append(self.executor.submit(self._synthesize_all, model, speaker, sentence, length_scale))
+                yield pcm
+
+        finally:
+            for future in running:
+                future.cancel()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Applies the pre_process_map rules in as few passes over the text as possible.
+#
+# Rules are applied in order, and a later rule can match the output of an earlier one, so they can't
+# simply be merged into one regex. Consecutive rules are grouped when it can be shown that applying
+# the group in a single pass gives exactly the same result as applying the rules one at a time:
+#  * literal rules (like '&amp;' or ' ESG ') are grouped if no two patterns can overlap in the text,
+#    and no pattern can match any part of an earlier replacement.
+#  * regex rules are grouped if the characters they can match are disjoint from each other and from
+#    the earlier replacements, and they don't use anchors, lookarounds, backreferences or flags.
+#  * a rule which can replace with an empty string can only be the last in a group, because removing
+#    text can join what's left into a new match.
+# Every group is then one regex alternation, and everything else falls back to a plain re.sub.
+# Run this file for a benchmark against the sequential re.sub version.
+import re
+
+try:
+    import re._parser as sre_parse # python >= 3.11
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+_MAX_CHARSET = 4096
+_GROUP_REF = re.compile(r'\\(?:[0-9]+|g<[^>]*>)')
+
+def _literal(pattern: str):
+    # the plain text a pattern matches, or None if it's not a literal pattern
+    text = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                text.append(pattern[i + 1])
+                i += 2
+                continue
+            return None
+        if c in '.^$*+?{}[]|()':
+            return None
+        text.append(c)
+        i += 1
+
+    return ''.join(text) or None
+
+def _charset(items):
+    # every character the parsed pattern can match, or None if that isn't a small, simple set
+    chars = set()
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_constants.IN:
+            for iop, iav in av:
+                if iop is sre_constants.LITERAL:
+                    chars.add(chr(iav))
+                elif iop is sre_constants.RANGE and iav[1] - iav[0] < _MAX_CHARSET:
+                    chars.update(chr(c) for c in range(iav[0], iav[1] + 1))
+                else: # NEGATE, CATEGORY, etc.
+                    return None
+        elif op is sre_constants.BRANCH:
+            for branch in av[1]:
+                sub = _charset(branch)
+                if sub is None:
+                    return None
+                chars |= sub
+        elif op is sre_constants.SUBPATTERN:
+            if av[1] or av[2]: # inline flags
+                return None
+            sub = _charset(av[3])
+            if sub is None:
+                return None
+            chars |= sub
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            sub = _charset(av[2])
+            if sub is None:
+                return None
+            chars |= sub
+        else: # ANY, AT, ASSERT, GROUPREF, etc.
+            return None
+
+        if len(chars) > _MAX_CHARSET:
+            return None
+
+    return chars
+
+def _overlaps(a: str, b: str) -> bool:
+    # can a and b overlap when placed in the same text? (one contains the other, or they share an edge)
+    if a in b or b in a:
+        return True
+    for n in range(1, min(len(a), len(b))):
+        if a[-n:] == b[:n] or b[-n:] == a[:n]:
+            return True
+    return False
+
+class rule():
+    def __init__(self, pattern: str, repl: str):
+        self.pattern = pattern
+        self.repl = repl
+        self.regex = re.compile(pattern)
+        self.literal = _literal(pattern) if '\\' not in repl else None
+        self.charset = None
+
+        if self.literal is not None:
+            self.charset = set(self.literal)
+            self.repl_chars = set(repl)
+            self.may_be_empty = not repl
+            return
+
+        parsed = sre_parse.parse(pattern)
+        if parsed.state.flags & ~(re.UNICODE | re.ASCII) or self.regex.groupindex:
+            return
+        if parsed.getwidth()[0] < 1:
+            return
+
+        template = _GROUP_REF.sub('', repl)
+        if '\\' in template:
+            return
+
+        self.charset = _charset(parsed)
+        if self.charset is None:
+            return
+
+        self.repl_chars = set(template)
+        if template != repl:
+            self.repl_chars |= self.charset
+        self.may_be_empty = not template
+
+    def groupable(self) -> bool:
+        return self.charset is not None
+
+    def before(self, later: 'rule') -> bool:
+        # True if this rule and a later rule give the same result in one pass
+        if self.may_be_empty:
+            return False
+        if self.literal is not None and later.literal is not None:
+            return not _overlaps(self.literal, later.literal) and not _overlaps(self.repl, later.literal)
+        return not (self.charset & later.charset) and not (self.repl_chars & later.charset)
+
+    def expand(self, text: str) -> str:
+        if self.literal is not None:
+            return self.repl
+        return self.regex.fullmatch(text).expand(self.repl)
+
+def _trie_regex(words: list) -> str:
+    # a regex for a set of literals with common prefixes factored out, Ex. &(?:amp|lt);
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = True
+
+    def build(node):
+        alts = [re.escape(c) + build(child) for c, child in sorted(node.items()) if c]
+        optional = '' in node
+        if not alts:
+            return ''
+        if len(alts) == 1 and not optional:
+            return alts[0]
+        return f"(?:{'|'.join(alts)}){'?' if optional else ''}"
+
+    return build(trie)
+
+class rule_group():
+    def __init__(self, rules: list):
+        self.rules = rules
+        if len(rules) == 1:
+            self.regex = rules[0].regex
+            self.repl = rules[0].repl
+        elif all(r.literal is not None for r in rules):
+            # no pattern is a prefix of another (they would overlap), so the longest match is the only match
+            self.literals = { r.literal: r.repl for r in rules }
+            self.regex = re.compile(_trie_regex(list(self.literals)))
+            self.repl = lambda m: self.literals[m.group()]
+        else:
+            self.regex = re.compile('|'.join(f"(?P<_{i}>{r.pattern})" for i, r in enumerate(rules)))
+            self.repl = self._replace
+
+    def _replace(self, m):
+        return self.rules[int(m.lastgroup[1:])].expand(m.group())
+
+    def apply(self, text: str) -> str:
+        return self.regex.sub(self.repl, text)
+
+class preprocess_rules():
+    # A single re.sub with a literal is a very fast substring search, an alternation has to check
+    # every position, so small groups are only used when all the literals start with the same character.
+    min_group: int = 4
+
+    def __init__(self, pairs):
+        self.groups = []
+        group = []
+        for a, b in pairs:
+            r = rule(a, b)
+            if group and r.groupable() and group[-1].groupable() and all(prev.before(r) for prev in group):
+                group.append(r)
+            else:
+                self._add_group(group)
+                group = [r]
+        self._add_group(group)
+
+    def _add_group(self, rules: list):
+        if not rules:
+            return
+        if len(rules) >= self.min_group or all(r.literal is not None and r.literal[0] == rules[0].literal[0] for r in rules):
+            self.groups.append(rule_group(rules))
+        else:
+            self.groups.extend(rule_group([r]) for r in rules)
+
+    def __len__(self):
+        return sum(len(g.rules) for g in self.groups)
+
+    def apply(self, text: str) -> str:
+        for group in self.groups:
+            text = group.apply(text)
+        return text
+
+def apply_sequential(pairs, text: str) -> str:
+    # the reference behaviour, one re.sub per rule
+    for a, b in pairs:
+        text = re.sub(a, b, text)
+    return text
+
+if __name__ == "__main__":
+    # micro benchmark: python preprocess_engine.py [--map pre_process_map.default.yaml] [--size 1000000] [--entities 200]
+    import argparse
+    import random
+    import timeit
+    import yaml
+
+    parser = argparse.ArgumentParser(description='pre_process_map benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--map', action='store', default='pre_process_map.default.yaml', help="The pre process map to test")
+    parser.add_argument('--size', action='store', default=1000000, type=int, help="Input text size in characters")
+    parser.add_argument('--entities', action='store', default=200, type=int, help="Also test with this many extra literal rules, like a large custom map")
+    parser.add_argument('-n', '--number', action='store', default=3, type=int, help="Number of runs")
+    args = parser.parse_args()
+
+    with open(args.map, 'r', encoding='utf8') as file:
+        pairs = yaml.safe_load(file)
+
+    # mostly plain prose, with the occasional word that needs replacing
+    random.seed(0)
+    words = "the quick brown fox jumped over the lazy dog and then went home to sleep for the night".split()
+    special = ["e.g.", "ex.", "&amp;", "&lt;b&gt;", "&quot;quoted&quot;", "2024-2025", "ESG", "FY", "biases", "&nbsp;", "done."]
+    extra = [[f"&ent{i};", f"<{i}>"] for i in range(args.entities)]
+    special += [a for a, _ in extra[:20]]
+    text = ' '.join(random.choice(special) if random.random() < 0.02 else random.choice(words) for _ in range(args.size // 5))[:args.size]
+
+    for name, rules in [("map", pairs), (f"map + {args.entities} literal rules", pairs + extra)]:
+        engine = preprocess_rules(rules)
+        assert engine.apply(text) == apply_sequential(rules, text), "output differs from sequential re.sub"
+        seq = min(timeit.repeat(lambda: apply_sequential(rules, text), number=1, repeat=args.number))
+        one = min(timeit.repeat(lambda: engine.apply(text), number=1, repeat=args.number))
+        print(f"{name}: {len(rules)} rules in {len(engine.groups)} passes, {len(text)} chars: sequential {seq*1000:.1f}ms, grouped {one*1000:.1f}ms ({seq/one:.1f}x)")
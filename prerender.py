@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Prerendered phrases: config/prerender.yaml lists phrases x voices x formats (Ex. IVR prompts, notifications),
+# which are rendered in the background at startup and again whenever they change, and kept in memory, so a
+# matching /v1/audio/speech request is answered without any synthesis.
+#
+# They are matched with the speech cache key, which includes the voice configuration and the preprocessed text,
+# so a change to a voice or to the pre process map is a change too: the old audio is dropped and the phrases
+# are rendered again.
+import asyncio
+import time
+
+from loguru import logger
+
+from openedai import RateLimitError
+import metrics
+
+class prerender_store():
+    def __init__(self, render, key, phrases, check_seconds: float = 10.0):
+        self.render = render # async (request dict) -> bytes
+        self.key = key # request dict -> cache key, raises on a bad request
+        self.phrases = phrases # () -> [request dict]
+        self.check_seconds = check_seconds
+        self.audio = {} # key -> encoded audio
+        self.bytes = 0
+        self.items = [] # [(request dict, key, error)] as configured
+        self.failed = {} # key -> error, not tried again until it's configured again
+        self.requests = 0
+        self.hits = 0
+        self.rendering = None # key of the phrase being rendered, its own lookup isn't a request
+        self.task = None
+
+    def get(self, key: str) -> bytes:
+        if key == self.rendering:
+            return None
+        data = self.audio.get(key, None)
+        self.requests += 1
+        if data is not None:
+            self.hits += 1
+        metrics.cache_requests.inc(cache='prerender', result='miss' if data is None else 'hit')
+        return data
+
+    def _configured(self) -> list:
+        try:
+            phrases = self.phrases()
+        except FileNotFoundError:
+            phrases = []
+        except Exception as e:
+            logger.error(f"Failed to load the prerendered phrases, keeping the old ones: {repr(e)}")
+            return None
+
+        items = []
+        for item in phrases:
+            try:
+                items.append((item, self.key(item), None))
+            except Exception as e:
+                items.append((item, None, f"Invalid request: {getattr(e, 'message', None) or repr(e)}"))
+        return items
+
+    def _drop(self, wanted: set):
+        for key in [key for key in self.audio if key not in wanted]:
+            self.bytes -= len(self.audio.pop(key))
+        self.failed = { key: error for key, error in self.failed.items() if key in wanted }
+
+    async def _refresh(self):
+        items = self._configured()
+        if items is None:
+            return
+        self.items = items
+        self._drop({ key for _, key, _ in items if key })
+
+        start, rendered = time.time(), 0
+        for item, key, _ in items:
+            if key is None or key in self.audio or key in self.failed:
+                continue
+            self.rendering = key
+            try:
+                data = await self.render(item)
+            except RateLimitError: # busy, the rest are rendered on the next check
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed[key] = getattr(e, 'message', None) or repr(e)
+                logger.error(f"Failed to prerender {item}: {repr(e)}")
+                continue
+            finally:
+                self.rendering = None
+            if key not in self.audio:
+                self.audio[key] = data
+                self.bytes += len(data)
+                rendered += 1
+
+        if rendered:
+            logger.info(f"Prerendered {rendered} phrases in {time.time() - start:.1f}s, {len(self.audio)} ready ({self.bytes / 1024 / 1024:.1f}MB)")
+
+    async def _run(self):
+        while True:
+            try:
+                await self._refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Prerender exception: {repr(e)}")
+            await asyncio.sleep(self.check_seconds)
+
+    def info(self) -> dict:
+        items = []
+        for item, key, error in self.items:
+            data = self.audio.get(key, None) if key else None
+            error = error or self.failed.get(key, None)
+            status = 'ready' if data is not None else 'failed' if error else 'pending'
+            items.append({ **item, 'status': status, 'bytes': len(data) if data is not None else 0, 'error': error })
+
+        return {
+            'object': 'speech.prerender',
+            'total': len(items),
+            'ready': sum(1 for item in items if item['status'] == 'ready'),
+            'pending': sum(1 for item in items if item['status'] == 'pending'),
+            'failed': sum(1 for item in items if item['status'] == 'failed'),
+            'bytes': self.bytes,
+            'requests': self.requests, # /v1/audio/speech requests looked up while there were prerendered phrases
+            'hits': self.hits,
+            'items': items,
+        }
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def shutdown(self):
+        if self.task:
+            self.task.cancel()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Cache of encoded /v1/audio/speech responses, with an in memory tier and an optional disk tier.
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import threading
+
+from loguru import logger
+
+import metrics
+
+def cache_key(model: str, voice_conf: dict, text: str, speed: float, response_format: str) -> str:
+    key = json.dumps([model, dict(voice_conf), text, speed, response_format], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class response_cache():
+    def __init__(self, max_mb: int = 256, cache_dir: str = None, max_disk_mb: int = 1024):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+        self.mem = collections.OrderedDict() # key -> bytes
+        self.mem_bytes = 0
+        self.disk = collections.OrderedDict() # key -> size
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # oldest first, so the least recently used are evicted first after a restart
+            entries = [e for e in os.scandir(self.cache_dir) if e.is_file() and e.name.endswith('.bin')]
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                size = entry.stat().st_size
+                self.disk[entry.name[:-4]] = size
+                self.disk_bytes += size
+            self._evict_disk()
+            logger.info(f"Response cache: {len(self.disk)} entries ({self.disk_bytes / 1024 / 1024:.1f}MB) in {self.cache_dir}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.bin")
+
+    def _evict_mem(self):
+        while self.mem_bytes > self.max_bytes and self.mem:
+            _, data = self.mem.popitem(last=False)
+            self.mem_bytes -= len(data)
+
+    def _evict_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+    def _put_mem(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.mem:
+            self.mem_bytes -= len(self.mem.pop(key))
+        self.mem[key] = data
+        self.mem_bytes += len(data)
+        self._evict_mem()
+
+    def _read(self, key: str) -> bytes:
+        # in a thread, None if the file is gone
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(key))
+            return data
+        except OSError:
+            with self.lock:
+                if key in self.disk:
+                    self.disk_bytes -= self.disk.pop(key)
+            return None
+
+    def _write(self, key: str, data: bytes):
+        # in a thread
+        tmp = self._path(key) + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            logger.warning(f"Response cache write failed: {repr(e)}")
+            return
+
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = len(data)
+                self.disk_bytes += len(data)
+                self._evict_disk()
+
+    async def get(self, key: str) -> bytes:
+        # the disk tier is read in a thread, so the event loop doesn't wait for it
+        with self.lock:
+            if key in self.mem:
+                self.mem.move_to_end(key)
+                self.hits += 1
+                metrics.cache_requests.inc(cache='speech', result='hit')
+                return self.mem[key]
+            on_disk = key in self.disk
+
+        data = await asyncio.to_thread(self._read, key) if on_disk else None
+
+        with self.lock:
+            if data is not None:
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                self._put_mem(key, data)
+                self.hits += 1
+                metrics.cache_requests.inc(cache='speech', result='disk')
+                return data
+
+            self.misses += 1
+            metrics.cache_requests.inc(cache='speech', result='miss')
+            return None
+
+    async def put(self, key: str, data: bytes):
+        with self.lock:
+            self._put_mem(key, data)
+            to_disk = self.cache_dir and key not in self.disk and len(data) <= self.max_disk_bytes
+
+        if to_disk:
+            await asyncio.to_thread(self._write, key, data)
+
+    async def tee(self, key: str, stream, complete=lambda: True):
+        # pass the stream through, and cache it if it finished without errors and isn't too big for the cache
+        max_bytes = max(self.max_bytes, self.max_disk_bytes if self.cache_dir else 0)
+        data = bytearray()
+        async for chunk in stream:
+            if data is not None:
+                data.extend(chunk)
+                if len(data) > max_bytes:
+                    data = None # not kept from here on
+            yield chunk
+
+        if data and complete():
+            await self.put(key, bytes(data))
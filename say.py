@@ -2,6 +2,8 @@
 
 import sys
 import os
+import re
+import time
 import atexit
 import tempfile
 import argparse
@@ -17,6 +19,11 @@ try:
 except ImportError:
     playsound = None
 
+try:
+    import sounddevice
+except ImportError:
+    sounddevice = None
+
 import openai
 
 
@@ -31,6 +38,8 @@ def parse_args(argv):
     parser.add_argument("-s", "--speed", type=float, default=1.0, help="playback speed, 0.25-4.0")
     parser.add_argument("-t", "--text", type=str, default=None, help="Provide text to read on the command line")
     parser.add_argument("-i", "--input", type=str, default=None, help="Read text from a file (default is to read from stdin)")
+    parser.add_argument("-S", "--stream", action="store_true", help="Play the audio while it's generated (pcm, requires: pip install sounddevice)")
+    parser.add_argument("-b", "--benchmark", action="store_true", help="Report the time to first byte, the total time and the real-time factor (pcm, the audio isn't saved or played)")
     
     if playsound is None:
         parser.add_argument("-o", "--output", type=str, help="The filename to save the output to") # required
@@ -51,8 +60,12 @@ if __name__ == "__main__":
         print("playsound module not found, audio will not be played, use -o <filename> to save output to a file. pip install playsound")
         sys.exit(1)
 
-    if not args.playsound and not args.output:
-        print("Must select one of playsound (-p) or output file name (-o)")
+    if args.stream and sounddevice is None:
+        print("sounddevice module not found, audio can not be streamed. pip install sounddevice")
+        sys.exit(1)
+
+    if not args.playsound and not args.output and not args.stream and not args.benchmark:
+        print("Must select one of playsound (-p), stream (-S), benchmark (-b) or output file name (-o)")
         sys.exit(1)
 
     if args.input is None and args.text is None:
@@ -75,6 +88,49 @@ if __name__ == "__main__":
         base_url = os.environ.get("OPENAI_BASE_URL", "http://localhost:8000/v1"),
     )
 
+    if args.stream or args.benchmark:
+        # pcm chunks as they arrive, s16le mono at the rate in the content-type
+        start = time.time()
+        first_byte = None
+        audio_bytes = 0
+        stream = None
+        rest = b''
+
+        with client.audio.speech.with_streaming_response.create(
+            model=args.model,
+            voice=args.voice,
+            speed=args.speed,
+            response_format='pcm',
+            input=text,
+        ) as response:
+            rate = re.search(r'rate=(\d+)', response.headers.get('content-type', ''))
+            sample_rate = int(rate.group(1)) if rate else 24000
+
+            if args.stream and not args.benchmark:
+                stream = sounddevice.RawOutputStream(samplerate=sample_rate, channels=1, dtype='int16')
+                stream.start()
+
+            try:
+                for chunk in response.iter_bytes():
+                    if first_byte is None:
+                        first_byte = time.time() - start
+                    audio_bytes += len(chunk)
+                    if stream:
+                        chunk = rest + chunk
+                        rest = chunk[len(chunk) - len(chunk) % 2:]
+                        stream.write(chunk[:len(chunk) - len(rest)])
+                total = time.time() - start
+            finally:
+                if stream:
+                    stream.stop() # waits for the buffered audio to play
+                    stream.close()
+
+        if args.benchmark:
+            audio_seconds = audio_bytes / 2 / sample_rate
+            print(f"ttfb: {first_byte or 0:.3f}s, total: {total:.3f}s, audio: {audio_seconds:.2f}s, real-time factor: {audio_seconds / total:.2f}x ({len(text)} chars, {args.model}, {args.voice})")
+
+        sys.exit(0)
+
     if args.playsound and args.output is None:
         _, args.output = tempfile.mkstemp(suffix='.wav')
         
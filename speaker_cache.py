@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Cache of xtts speaker conditioning latents, keyed by the model checkpoint and the sample files, with their mtime and size.
+import hashlib
+import os
+import threading
+
+from loguru import logger
+
+import metrics
+
+def list_samples(samples: str) -> list[str]:
+    if os.path.isfile(samples):
+        return [samples]
+    if os.path.isdir(samples):
+        return sorted(os.path.join(samples, sample) for sample in os.listdir(samples) if os.path.isfile(os.path.join(samples, sample)))
+    raise FileNotFoundError(samples)
+
+def checkpoint_version(model_path: str) -> str:
+    # the files of a model directory, so latents aren't reused after the checkpoint is retrained or replaced
+    files = sorted((entry for entry in os.scandir(model_path) if entry.is_file()), key=lambda entry: entry.name)
+    return f"{os.path.abspath(model_path)}\n" + ''.join(f"{entry.name}:{entry.stat().st_mtime_ns}:{entry.stat().st_size}\n" for entry in files)
+
+class speaker_cache():
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir
+        self.latents = {} # key -> (gpt_cond_latent, speaker_embedding)
+        self.current = {} # (model, checkpoint, samples) -> key, to drop stale entries when a sample changes
+        self.dirs = {} # dir -> (mtime, samples)
+        self.lock = threading.Lock()
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def samples(self, samples: str) -> list[str]:
+        # directory listings are reused until the directory changes
+        try:
+            st = os.stat(samples)
+        except OSError:
+            raise FileNotFoundError(samples)
+
+        if os.path.isfile(samples):
+            return [samples]
+
+        cached = self.dirs.get(samples)
+        if cached and cached[0] == st.st_mtime_ns:
+            return cached[1]
+
+        audio_path = list_samples(samples)
+        self.dirs[samples] = (st.st_mtime_ns, audio_path)
+        return audio_path
+
+    def key(self, model: str, audio_path: list[str], checkpoint: str = '') -> str:
+        h = hashlib.sha1(f"{model}\n{checkpoint}".encode('utf-8'))
+        for path in sorted(audio_path):
+            st = os.stat(path)
+            h.update(f"{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}\n".encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, model: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{os.path.basename(model)}-{key}.pth")
+
+    def get(self, model: str, audio_path: list[str], compute, device=None, checkpoint: str = ''):
+        import torch
+
+        key = self.key(model, audio_path, checkpoint)
+        name = (model, checkpoint, tuple(sorted(audio_path))) # the same as the key, without the sample versions
+
+        with self.lock:
+            if key in self.latents:
+                metrics.cache_requests.inc(cache='speaker', result='hit')
+                return self.latents[key]
+
+            old_key = self.current.get(name)
+            if old_key:
+                logger.debug(f"Speaker samples changed: {audio_path}")
+                self.latents.pop(old_key, None)
+                if self.cache_dir:
+                    try:
+                        os.unlink(self._path(model, old_key))
+                    except OSError:
+                        pass
+
+        latents = None
+        if self.cache_dir and os.path.exists(self._path(model, key)):
+            try:
+                gpt_cond_latent, speaker_embedding = torch.load(self._path(model, key), map_location=device)
+                latents = (gpt_cond_latent, speaker_embedding)
+                metrics.cache_requests.inc(cache='speaker', result='disk')
+            except Exception as e:
+                logger.warning(f"Failed to load speaker latents {self._path(model, key)}: {repr(e)}")
+
+        if latents is None:
+            metrics.cache_requests.inc(cache='speaker', result='miss')
+            latents = compute(audio_path=audio_path)
+            if self.cache_dir:
+                try:
+                    torch.save(tuple(t.cpu() for t in latents), self._path(model, key))
+                except Exception as e:
+                    logger.warning(f"Failed to save speaker latents {self._path(model, key)}: {repr(e)}")
+
+        with self.lock:
+            self.latents[key] = latents
+            self.current[name] = key
+
+        return latents
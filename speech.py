@@ -1,65 +1,106 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import contextlib
 import gc
+import importlib.util
+import itertools
 import os
-import queue
-import re
-import subprocess
 import sys
 import threading
 import time
-import yaml
-import json
 
-from fastapi.responses import StreamingResponse
+from fastapi import Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
 from loguru import logger
-from openedai import OpenAIStub, BadRequestError, ServiceUnavailableError
+from openedai import OpenAIStub, log_requests, APIError, BadRequestError, NotFoundError, ServiceUnavailableError, RateLimitError
+from piper_engine import piper_pool, piper_session_cache, piper_parallel
+from audio_encoder import audio_encoders, threaded_iter
+from response_cache import response_cache, cache_key
+from speaker_cache import speaker_cache, list_samples, checkpoint_version
+from xtts_batcher import xtts_batcher
+from model_registry import model_registry
+from tracing import request_trace, trace_sink
+from language_detector import language_detector
+from admission import admission_gate, per_model, priority_keys, request_priority
+from batch_jobs import batch_runner
+from pcm_buffer import pcm_frames
+from time_stretch import split_speed, stretch_pcm
+from prerender import prerender_store
+from text_stream import sentence_stream, spacy_sentences, regex_sentences
+import metrics
+from config_cache import default_exists, pre_process_map, voice_to_speaker, prerender_phrases, piper_sample_rate
 from pydantic import BaseModel
 import uvicorn
 
 @contextlib.asynccontextmanager
 async def lifespan(app):
+    startup = asyncio.create_task(start_models()) # after this the server is listening
+    if batches:
+        batches.start()
+    if prerendered:
+        prerendered.start()
     yield
+    startup.cancel()
+    if prerendered:
+        prerendered.shutdown()
+    if batches:
+        batches.shutdown()
+    encoders.shutdown()
+    if xtts_models:
+        xtts_models.unload_all()
+    if piper_sentences:
+        piper_sentences.shutdown()
+    if piper_workers:
+        piper_workers.shutdown()
     gc.collect()
     try:
-        import torch
-        if torch.cuda.is_available():
+        if torch and torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.ipc_collect()
     except:
         pass
 
 app = OpenAIStub(lifespan=lifespan)
-xtts = None
+xtts_models = None
+piper_workers = None
+piper_sessions = None
+piper_sentences = None
+speech_cache = None
+speakers = None
+language_detect = None
+admission = {} # model -> admission_gate
+api_key_priorities = {}
+batches = None
+prerendered = None
+pcm_pool = pcm_frames() # replaced in setup_server()
+encoders = audio_encoders()
 args = None
+process_start = time.time()
 
-def unload_model():
-    import torch, gc
-    global xtts
-    if xtts:
-        logger.info("Unloading model")
-        xtts.xtts.to('cpu') # this was required to free up GPU memory... 
-        del xtts
-        xtts = None
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
+# imported by import_xtts()
+torch = None
+XttsConfig = None
+Xtts = None
+ModelManager = None
+split_sentence = None
+xtts_import_lock = threading.Lock()
 
 class xtts_wrapper():
-    check_interval: int = 1 # too aggressive?
-
-    def __init__(self, model_name, device, model_path=None, unload_timer=None):
+    def __init__(self, model_name, device, model_path=None, batch_size=1, batch_wait=0.02):
+        self.key = (model_name, model_path)
         self.model_name = model_name
-        self.unload_timer = unload_timer
+        self.device = device
         self.last_used = time.time()
-        self.timer = None
+        self.batcher = None
         self.lock = threading.Lock()
 
         logger.info(f"Loading model {self.model_name} to {device}")
 
         if model_path is None:
             model_path = ModelManager().download_model(model_name)[0]
+        self.checkpoint = checkpoint_version(model_path) # of the files loaded, for the speaker latents
 
         config_path = os.path.join(model_path, 'config.json')
         config = XttsConfig()
@@ -68,83 +109,133 @@ class xtts_wrapper():
         self.xtts.load_checkpoint(config, checkpoint_dir=model_path, use_deepspeed=args.use_deepspeed)  # XXX there are no prebuilt deepspeed wheels??
         self.xtts = self.xtts.to(device=device)
         self.xtts.eval()
+        self.bytes = sum(t.numel() * t.element_size() for t in itertools.chain(self.xtts.parameters(), self.xtts.buffers()))
 
-        if self.unload_timer:
-            logger.info(f"Setting unload timer to {self.unload_timer} seconds")
-            self.last_used = time.time()
-            self.check_idle()
+        if batch_size > 1:
+            logger.info(f"Batching xtts requests, up to {batch_size} sentences")
+            self.batcher = xtts_batcher(self, max_batch=batch_size, max_wait=batch_wait)
 
-    def check_idle(self):
-        with self.lock:
-            if time.time() - self.last_used >= self.unload_timer:
-                print("Unloading TTS model due to inactivity")
-                unload_model()
-            else:
-                # Reschedule the check
-                self.timer = threading.Timer(self.check_interval, self.check_idle)
-                self.timer.daemon = True
-                self.timer.start()
+    def size(self) -> int:
+        return self.bytes
+
+    def unload(self):
+        if self.batcher:
+            self.batcher.stop()
+        self.xtts.to('cpu') # this was required to free up GPU memory... 
+        del self.xtts
+
+    def get_conditioning_latents(self, audio_path):
+        if speakers is None:
+            return self.xtts.get_conditioning_latents(audio_path=audio_path)
 
-    def tts(self, text, language, audio_path, **hf_generate_kwargs):
+        return speakers.get(self.model_name, audio_path, self.xtts.get_conditioning_latents, device=self.device, checkpoint=self.checkpoint)
+
+    def tts(self, text, language, audio_path, trace=None, **hf_generate_kwargs):
         with torch.no_grad():
-            self.last_used = time.time()
-            tokens = 0
+            start = time.time()
+            self.last_used = start
+            chunks = 0
+            waited = 0.0 # for the lock
             try:
+                wait = time.time()
                 with self.lock:
+                    waited += time.time() - wait
                     logger.debug(f"generating [{language}]: {[text]}")
 
-                    gpt_cond_latent, speaker_embedding = self.xtts.get_conditioning_latents(audio_path=audio_path) # not worth caching calls, it's < 0.001s after model is loaded
+                    latents = time.time()
+                    gpt_cond_latent, speaker_embedding = self.get_conditioning_latents(audio_path)
+                    if trace:
+                        trace.add('latents', time.time() - latents)
                     pcm_stream = self.xtts.inference_stream(text, language, gpt_cond_latent, speaker_embedding, **hf_generate_kwargs)
                     self.last_used = time.time()
 
                 while True:
+                    wait = time.time()
                     with self.lock:
-                        yield next(pcm_stream).cpu().numpy().tobytes()
+                        waited += time.time() - wait
+                        yield next(pcm_stream).cpu().numpy() # copied into the pcm frames, not .tobytes()
                         self.last_used = time.time()
-                    tokens += 1
+                    chunks += 1
 
             except StopIteration:
                 pass
 
             finally:
-                logger.debug(f"Generated {tokens} tokens in {time.time() - self.last_used:.2f}s @ {tokens / (time.time() - self.last_used):.2f} T/s")
+                elapsed = time.time() - start
+                tokens = chunks * hf_generate_kwargs.get('stream_chunk_size', 20) # estimate, the last chunk is usually shorter
+                metrics.lock_wait.observe(waited, model=self.model_name)
+                if trace:
+                    trace.add('lock_wait', waited)
+                    trace.add('xtts', elapsed - waited)
+                if chunks and elapsed > 0:
+                    metrics.tokens_per_second.observe(tokens / elapsed, model=self.model_name)
+                    logger.debug(f"Generated {chunks} chunks (~{tokens} tokens) in {elapsed:.2f}s @ {tokens / elapsed:.2f} T/s, {waited:.2f}s waiting")
                 self.last_used = time.time()
 
-def default_exists(filename: str):
-    if not os.path.exists(filename):
-        fpath, ext = os.path.splitext(filename)
-        basename = os.path.basename(fpath)
-        default = f"{basename}.default{ext}"
-        
-        logger.info(f"{filename} does not exist, setting defaults from {default}")
+    def tts_batched(self, all_text, language, audio_path, trace=None, **hf_generate_kwargs):
+        # all the sentences are queued at once, and generated together with other requests
+        with self.lock:
+            latents = time.time()
+            gpt_cond_latent, speaker_embedding = self.get_conditioning_latents(audio_path)
+            self.last_used = time.time()
+            if trace:
+                trace.add('latents', self.last_used - latents)
+
+        yield from self.batcher.tts(all_text, language, gpt_cond_latent, speaker_embedding, **hf_generate_kwargs)
+
+# torch and TTS take a while to import, it's done when xtts is first used (or preloaded), not at startup
+def import_xtts():
+    global torch, XttsConfig, Xtts, ModelManager, split_sentence
+    with xtts_import_lock:
+        if Xtts is not None:
+            return
 
-        with open(default, 'r', encoding='utf8') as from_file:
-            with open(filename, 'w', encoding='utf8') as to_file:
-                to_file.write(from_file.read())
+        start = time.time()
+        import torch
+        if args.xtts_device == 'auto':
+            args.xtts_device = torch_device()
+        from TTS.tts.configs.xtts_config import XttsConfig
+        from TTS.utils.manage import ModelManager
+        from TTS.tts.layers.xtts.tokenizer import split_sentence
+        from TTS.tts.models.xtts import Xtts # last, the others are imported when it's set
+        logger.info(f"Imported torch and TTS in {time.time() - start:.2f}s, xtts device: {args.xtts_device}")
+
+def load_xtts(key, version=None):
+    import_xtts()
+    model_name, model_path = key
+    return xtts_wrapper(model_name, device=args.xtts_device, model_path=model_path, batch_size=args.xtts_batch_size, batch_wait=args.xtts_batch_wait_ms / 1000)
+
+def xtts_status() -> dict:
+    models = [ { 'model': model_name, 'model_path': model_path, **info } for (model_name, model_path), info in xtts_models.status() ]
+    states = set(m['state'] for m in models)
+    status = 'loaded' if 'loaded' in states else 'loading' if 'loading' in states else 'unloaded'
+    return { 'status': status, 'models': models }
+
+# A fine-tuned model is reloaded when its files change
+def xtts_model_version(model_path):
+    if not model_path:
+        return None
+    try:
+        return max(entry.stat().st_mtime_ns for entry in os.scandir(model_path) if entry.is_file())
+    except (OSError, ValueError):
+        return None
 
-# Read pre process map on demand so it can be changed without restarting the server
+# The pre process map is reloaded when it changes so it can be changed without restarting the server
 def preprocess(raw_input):
     #logger.debug(f"preprocess: before: {[raw_input]}")
-    default_exists('config/pre_process_map.yaml')
-    with open('config/pre_process_map.yaml', 'r', encoding='utf8') as file:
-        pre_process_map = yaml.safe_load(file)
-        for a, b in pre_process_map:
-            raw_input = re.sub(a, b, raw_input)
-    
+    raw_input = pre_process_map.get().apply(raw_input)
     raw_input = raw_input.strip()
     #logger.debug(f"preprocess: after: {[raw_input]}")
     return raw_input
 
-# Read voice map on demand so it can be changed without restarting the server
+# The voice map is reloaded when it changes so it can be changed without restarting the server, voices are read only.
 def map_voice_to_speaker(voice: str, model: str):
-    default_exists('config/voice_to_speaker.yaml')
-    with open('config/voice_to_speaker.yaml', 'r', encoding='utf8') as file:
-        voice_map = yaml.safe_load(file)
-        try:
-            return voice_map[model][voice]
+    voice_map = voice_to_speaker.get()
+    try:
+        return voice_map[model][voice]
 
-        except KeyError as e:
-            raise BadRequestError(f"Error loading voice: {voice}, KeyError: {e}", param='voice')
+    except KeyError as e:
+        raise BadRequestError(f"Error loading voice: {voice}, KeyError: {e}", param='voice')
 
 class GenerateSpeechRequest(BaseModel):
     model: str = "tts-1" # or "tts-1-hd"
@@ -153,35 +244,19 @@ class GenerateSpeechRequest(BaseModel):
     response_format: str = "mp3" # mp3, opus, aac, flac
     speed: float = 1.0 # 0.25 - 4.0
 
-def build_ffmpeg_args(response_format, input_format, sample_rate):
-    # Convert the output to the desired format using ffmpeg
-    if input_format == 'WAV':
-        ffmpeg_args = ["ffmpeg", "-loglevel", "error", "-f", "WAV", "-i", "-"]
-    else:
-        ffmpeg_args = ["ffmpeg", "-loglevel", "error", "-f", input_format, "-ar", sample_rate, "-ac", "1", "-i", "-"]
-    
-    if response_format == "mp3":
-        ffmpeg_args.extend(["-f", "mp3", "-c:a", "libmp3lame", "-ab", "64k"])
-    elif response_format == "opus":
-        ffmpeg_args.extend(["-f", "ogg", "-c:a", "libopus"])
-    elif response_format == "aac":
-        ffmpeg_args.extend(["-f", "adts", "-c:a", "aac", "-ab", "64k"])
-    elif response_format == "flac":
-        ffmpeg_args.extend(["-f", "flac", "-c:a", "flac"])
-    elif response_format == "wav":
-        ffmpeg_args.extend(["-f", "wav", "-c:a", "pcm_s16le"])
-    elif response_format == "pcm": # even though pcm is technically 'raw', we still use ffmpeg to adjust the speed
-        ffmpeg_args.extend(["-f", "s16le", "-c:a", "pcm_s16le"])
-
-    return ffmpeg_args
-
 @app.post("/v1/audio/speech", response_class=StreamingResponse)
-async def generate_speech(request: GenerateSpeechRequest):
-    global xtts, args
+async def generate_speech(request: GenerateSpeechRequest, if_none_match: str = Header(None), authorization: str = Header(None), x_priority: str = Header(None)):
+    global xtts_models, piper_workers, piper_sessions, piper_sentences, speech_cache, args
+    trace = request_trace(model=request.model, voice=request.voice, format=request.response_format, chars=len(request.input))
+    request_start = trace.start
     if len(request.input) < 1:
         raise BadRequestError("Empty Input", param='input')
 
-    input_text = preprocess(request.input)
+    if xtts_models and args.reload_on_traffic:
+        xtts_models.wake()
+
+    with trace.span('preprocess'):
+        input_text = preprocess(request.input)
 
     if len(input_text) < 1:
         raise BadRequestError("Input text empty after preprocess.", param='input')
@@ -210,11 +285,35 @@ async def generate_speech(request: GenerateSpeechRequest):
     else:
         raise BadRequestError(f"Invalid response_format: '{response_format}'", param='response_format')
 
-    ffmpeg_args = None
-
     # Use piper for tts-1, and if xtts_device == none use for all models.
     if model == 'tts-1' or args.xtts_device == 'none':
-        voice_map = map_voice_to_speaker(voice, 'tts-1')
+        tts_engine = 'tts-1'
+    elif model == 'tts-1-hd':
+        tts_engine = 'tts-1-hd'
+    else:
+        raise BadRequestError("No such model, must be tts-1 or tts-1-hd.", param='model')
+
+    with trace.span('voice'):
+        voice_map = map_voice_to_speaker(voice, tts_engine)
+
+    headers = {}
+    if speech_cache or (prerendered and prerendered.audio):
+        with trace.span('cache'):
+            key = cache_key(tts_engine, voice_map, input_text, speed, response_format)
+            headers['ETag'] = f'"{key}"'
+            cached = prerendered.get(key) if prerendered and prerendered.audio else None
+            status = 'prerendered'
+            if cached is None and speech_cache:
+                cached = await speech_cache.get(key)
+                status = 'cached'
+        if cached is not None:
+            headers['Server-Timing'] = trace.server_timing()
+            trace.finish(status, bytes=len(cached))
+            if if_none_match and headers['ETag'] in if_none_match:
+                return Response(status_code=304, headers=headers)
+            return Response(content=cached, media_type=media_type, headers=headers)
+
+    if tts_engine == 'tts-1':
         try:
             piper_model = voice_map['model']
 
@@ -222,35 +321,56 @@ async def generate_speech(request: GenerateSpeechRequest):
             raise ServiceUnavailableError(f"Configuration error: tts-1 voice '{voice}' is missing 'model:' setting. KeyError: {e}")
 
         speaker = voice_map.get('speaker', None)
+        piper_speed, stretch = split_speed(speed, 0.5, 2.0) # piper speeds outside of this don't sound right
+        length_scale = 1.0/piper_speed if piper_speed != 1.0 else None
 
-        tts_args = ["piper", "--model", str(piper_model), "--data-dir", "voices", "--download-dir", "voices", "--output-raw"]
-        if speaker:
-            tts_args.extend(["--speaker", str(speaker)])
-        if speed != 1.0:
-            tts_args.extend(["--length-scale", f"{1.0/speed}"])
-
-        tts_proc = subprocess.Popen(tts_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        tts_proc.stdin.write(bytearray(input_text.encode('utf-8')))
-        tts_proc.stdin.close()
-
-        try:
-            with open(f"{piper_model}.json", 'r') as pvc_f:
-                conf = json.load(pvc_f)
-                sample_rate = str(conf['audio']['sample_rate'])
+        # In process and worker pool piper need the model on disk, otherwise let the piper cli download it
+        if os.path.exists(str(piper_model)):
+            piper_engine = piper_sentences or piper_sessions or piper_workers
+        else:
+            piper_engine = None
 
-        except:
-            sample_rate = '22050'
-  
-        ffmpeg_args = build_ffmpeg_args(response_format, input_format="s16le", sample_rate=sample_rate)
+        if piper_engine:
+            pcm_stream = threaded_iter(piper_engine.synthesize(str(piper_model), speaker, input_text, length_scale))
 
-        # Pipe the output from piper/xtts to the input of ffmpeg
-        ffmpeg_args.extend(["-"])
-        ffmpeg_proc = subprocess.Popen(ffmpeg_args, stdin=tts_proc.stdout, stdout=subprocess.PIPE)
+        else:
+            tts_args = ["piper", "--model", str(piper_model), "--data-dir", "voices", "--download-dir", "voices", "--output-raw"]
+            if speaker:
+                tts_args.extend(["--speaker", str(speaker)])
+            if length_scale:
+                tts_args.extend(["--length-scale", f"{length_scale}"])
+
+            async def piper_cli():
+                with metrics.spawn_seconds.time(process='piper'), trace.span('piper_start'):
+                    tts_proc = await asyncio.create_subprocess_exec(*tts_args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+                try:
+                    tts_proc.stdin.write(input_text.encode('utf-8'))
+                    await tts_proc.stdin.drain()
+                    tts_proc.stdin.close()
+
+                    while chunk := await tts_proc.stdout.read(65536):
+                        yield chunk
+
+                    if await tts_proc.wait() != 0:
+                        raise RuntimeError(f"piper exited with {tts_proc.returncode}")
+                finally:
+                    if tts_proc.returncode is None:
+                        tts_proc.kill()
+
+            pcm_stream = piper_cli()
+
+        sample_rate = piper_sample_rate(piper_model)
+        out_rate = '24000' if model == 'tts-1-hd' else '22050' # as in the media_type
+
+        meter = metrics.stream_meter(tts_engine, voice, int(sample_rate) * 2, start=request_start, trace=trace)
+        if stretch != 1.0:
+            pcm_stream = stretch_pcm(pcm_stream, 's16le', sample_rate, stretch)
+        pcm_stream = meter.pcm(pcm_stream) # the audio as it's sent, after the stretch
+        encoded = encoders.stream(pcm_stream, response_format, input_format="s16le", sample_rate=sample_rate, out_rate=out_rate, trace=trace)
 
-        return StreamingResponse(content=ffmpeg_proc.stdout, media_type=media_type)
     # Use xtts for tts-1-hd
-    elif model == 'tts-1-hd':
-        voice_map = map_voice_to_speaker(voice, 'tts-1-hd')
+    else:
+        voice_map = dict(voice_map) # settings are popped from it below
         try:
             tts_model = voice_map.pop('model')
             speaker = voice_map.pop('speaker')
@@ -258,43 +378,17 @@ async def generate_speech(request: GenerateSpeechRequest):
         except KeyError as e:
             raise ServiceUnavailableError(f"Configuration error: tts-1-hd voice '{voice}' is missing setting. KeyError: {e}")
 
-        if xtts and xtts.model_name != tts_model:
-            unload_model()
-
-        tts_model_path = voice_map.pop('model_path', None) # XXX changing this on the fly is ignored if you keep the same name
-
-        if xtts is None:
-            xtts = xtts_wrapper(tts_model, device=args.xtts_device, model_path=tts_model_path, unload_timer=args.unload_timer)
+        tts_model_path = voice_map.pop('model_path', None)
 
-        ffmpeg_args = build_ffmpeg_args(response_format, input_format="f32le", sample_rate="24000")
-
-        # tts speed doesn't seem to work well
-        speed = voice_map.pop('speed', speed)
-        if speed < 0.5:
-            speed = speed / 0.5
-            ffmpeg_args.extend(["-af", "atempo=0.5"]) 
-        if speed > 1.0:
-            ffmpeg_args.extend(["-af", f"atempo={speed}"]) 
-            speed = 1.0
-
-        # Pipe the output from piper/xtts to the input of ffmpeg
-        ffmpeg_args.extend(["-"])
+        # tts speed doesn't seem to work well outside of 0.5 - 1.0, the rest is a time stretch of the pcm
+        speed, stretch = split_speed(voice_map.pop('speed', speed), 0.5, 1.0)
 
         language = voice_map.pop('language', 'auto')
+        languages = voice_map.pop('languages', None) # for auto, Ex. [en, fr] or {en: 0.8, fr: 0.2}
         if language == 'auto':
-            try:
-                language = detect(input_text)
-                if language not in [
-                    'en', 'es', 'fr', 'de', 'it', 'pt', 'pl', 'tr',
-                    'ru', 'nl', 'cs', 'ar', 'zh-cn', 'hu', 'ko', 'ja', 'hi'
-                ]:
-                    logger.debug(f"Detected language {language} not supported, defaulting to en")
-                    language = 'en'
-                else:
-                    logger.debug(f"Detected language: {language}")
-            except:
-                language = 'en'
-                logger.debug(f"Failed to detect language, defaulting to en")
+            with trace.span('language'):
+                language = language_detect.detect(input_text, languages)
+            logger.debug(f"Detected language: {language}")
 
         comment = voice_map.pop('comment', None) # ignored.
 
@@ -305,141 +399,430 @@ async def generate_speech(request: GenerateSpeechRequest):
 
         hf_generate_kwargs['enable_text_splitting'] = hf_generate_kwargs.get('enable_text_splitting', True) # change the default to true
 
-        if hf_generate_kwargs['enable_text_splitting']:
-            if language == 'zh-cn':
-                split_lang = 'zh'
-            else:
-                split_lang = language
-            all_text = split_sentence(input_text, split_lang, xtts.xtts.tokenizer.char_limits[split_lang])
-        else:
-            all_text = [input_text]
-
-        ffmpeg_proc = subprocess.Popen(ffmpeg_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-
-        in_q = queue.Queue() # speech pcm 
-        ex_q = queue.Queue() # exceptions
-
-        def get_speaker_samples(samples: str) -> list[str]:
-            if os.path.isfile(samples):
-                audio_path = [samples]
-            elif os.path.isdir(samples):
-                audio_path = [os.path.join(samples, sample) for sample in os.listdir(samples) if os.path.isfile(os.path.join(samples, sample))]
-
-                if len(audio_path) < 1:
-                    logger.error(f"No files found: {samples}")
-                    raise ServiceUnavailableError(f"Invalid path: {samples}")
+        try:
+            with trace.span('samples'):
+                audio_path = speakers.samples(speaker) if speakers else list_samples(speaker)
+        except FileNotFoundError:
+            logger.error(f"Invalid path: {speaker}")
+            raise ServiceUnavailableError(f"Invalid path: {speaker}")
+
+        if len(audio_path) < 1:
+            logger.error(f"No files found: {speaker}")
+            raise ServiceUnavailableError(f"Invalid path: {speaker}")
+
+        logger.debug(f"{voice} wav samples: {audio_path}")
+
+        # loaded in a thread, other requests keep going while it loads
+        with trace.span('model'):
+            lease = await xtts_models.lease_async((tts_model, tts_model_path), xtts_model_version(tts_model_path)) # it's not unloaded while it's in use
+        xtts = lease.model
+
+        try: # until the generator owns the lease
+            if hf_generate_kwargs['enable_text_splitting']:
+                if language == 'zh-cn':
+                    split_lang = 'zh'
+                else:
+                    split_lang = language
+                with trace.span('split'):
+                    all_text = split_sentence(input_text, split_lang, xtts.xtts.tokenizer.char_limits[split_lang])
             else:
-                logger.error(f"Invalid path: {samples}")
-                raise ServiceUnavailableError(f"Invalid path: {samples}")
-            
-            return audio_path
-
-        def exception_check(exq: queue.Queue):
-            try:
-                e = exq.get_nowait()
-            except queue.Empty:
-                return
-            
-            raise e
+                all_text = [input_text]
+        except BaseException:
+            lease.release()
+            raise
 
         def generator():
-            # text -> in_q
-
-            audio_path = get_speaker_samples(speaker)
-            logger.debug(f"{voice} wav samples: {audio_path}")
-
+            # text -> pcm, runs in a thread, closed when the client disconnects
             try:
-                for text in all_text:
-                    for chunk in xtts.tts(text=text, language=language, audio_path=audio_path, **hf_generate_kwargs):
-                        exception_check(ex_q)
-                        in_q.put(chunk)
+                if xtts.batcher:
+                    yield from xtts.tts_batched(all_text, language=language, audio_path=audio_path, trace=trace, **hf_generate_kwargs)
+                else:
+                    for text in all_text:
+                        yield from xtts.tts(text=text, language=language, audio_path=audio_path, trace=trace, **hf_generate_kwargs)
 
-            except BrokenPipeError as e: # client disconnect lands here
-                logger.info("Client disconnected - 'Broken pipe'")
+            except GeneratorExit: # client disconnect lands here
+                logger.info("Client disconnected")
+                raise
 
             except Exception as e:
                 logger.error(f"Exception: {repr(e)}")
                 raise e
-        
-            finally:
-                in_q.put(None) # sentinel
 
-        def out_writer(): 
-            # in_q -> ffmpeg
-            try:
-                while True:
-                    chunk = in_q.get()
-                    if chunk is None: # sentinel
-                        break
-                    ffmpeg_proc.stdin.write(chunk) # BrokenPipeError from here on client disconnect
-
-            except Exception as e: # BrokenPipeError
-                ex_q.put(e)  # we need to get this exception into the generation loop
-                ffmpeg_proc.kill()
-                return
-            
             finally:
-                ffmpeg_proc.stdin.close()
+                lease.release()
+
+        meter = metrics.stream_meter(tts_engine, voice, 24000 * 4, start=request_start, trace=trace)
+        pcm_stream = pcm_pool.stream(generator(), max_bytes=args.pcm_stream_mb * 1024 * 1024)
+        if stretch != 1.0:
+            pcm_stream = stretch_pcm(pcm_stream, 'f32le', 24000, stretch)
+        pcm_stream = meter.pcm(pcm_stream)
+        encoded = encoders.stream(pcm_stream, response_format, input_format="f32le", sample_rate="24000", trace=trace)
+
+    # nothing was generated yet, the pcm and encoder start when the response is streamed
+    gate = admission.get(tts_engine)
+    if gate:
+        try:
+            with trace.span('queue'):
+                slot = await gate.acquire(request_priority(api_key_priorities, authorization, x_priority))
+        except BaseException as e:
+            if tts_engine == 'tts-1-hd':
+                lease.release()
+            if isinstance(e, RateLimitError):
+                trace.finish('rejected')
+            raise
+
+    content = encoded.content
+    if speech_cache:
+        content = speech_cache.tee(key, content, encoded.completed)
+    content = meter.content(content)
+    if gate:
+        content = slot.hold(content)
+
+    # the stages after this are only in the log
+    headers['Server-Timing'] = trace.server_timing()
+
+    return StreamingResponse(content=content, media_type=media_type, headers=headers, background=BackgroundTask(encoded.close))
+
+
+# The speech cache key of a request, as in generate_speech()
+def speech_key(item: dict) -> str:
+    request = GenerateSpeechRequest(**item)
+    if request.model == 'tts-1' or args.xtts_device == 'none':
+        tts_engine = 'tts-1'
+    elif request.model == 'tts-1-hd':
+        tts_engine = 'tts-1-hd'
+    else:
+        raise BadRequestError("No such model, must be tts-1 or tts-1-hd.", param='model')
+    voice_map = map_voice_to_speaker(request.voice, tts_engine)
+    return cache_key(tts_engine, voice_map, preprocess(request.input), request.speed, request.response_format.lower())
 
-        generator_worker = threading.Thread(target=generator, daemon=True)
-        generator_worker.start()
+async def speech_chunks(response):
+    # the body of a generate_speech() response, used in process
+    if not isinstance(response, StreamingResponse):
+        yield response.body
+        return
 
-        out_writer_worker = threading.Thread(target=out_writer, daemon=True)
-        out_writer_worker.start()
+    try:
+        async for chunk in response.body_iterator:
+            yield chunk
+    finally:
+        await response.body_iterator.aclose()
+        if response.background:
+            await response.background()
+
+# Batch jobs and prerendered phrases render the same way as a request, with the bulk priority
+async def render_speech(item: dict) -> bytes:
+    response = await generate_speech(GenerateSpeechRequest(**item), if_none_match=None, authorization=None, x_priority='bulk')
+    return b''.join([chunk async for chunk in speech_chunks(response)])
+
+# Text in, audio out, over one websocket session, Ex. for the tokens of an llm as they are generated.
+# The text is sent in json messages: {"text": "..."}, with "flush": true to speak the text so far, and
+# "end": true after the last one. Each sentence is generated as soon as it's complete and the audio of all of
+# them comes back through one encoder in binary messages, with {"type": "sentence", "text": "..."} when a
+# sentence starts and {"type": "done"} at the end.
+@app.websocket("/v1/audio/speech/stream")
+async def stream_speech(websocket: WebSocket, model: str = 'tts-1', voice: str = 'alloy', response_format: str = 'pcm', speed: float = 1.0):
+    await websocket.accept()
+    response_format = response_format.lower()
+    if response_format not in ['mp3', 'opus', 'aac', 'flac', 'wav', 'pcm']:
+        await websocket.send_json({ 'type': 'error', 'message': f"Invalid response_format: '{response_format}'" })
+        await websocket.close(code=1008)
+        return
+
+    authorization = websocket.headers.get('authorization', None)
+    x_priority = websocket.headers.get('x-priority', None)
+    sample_rate = 24000 if model == 'tts-1-hd' else 22050 # the rate of the pcm response_format
+
+    split = regex_sentences
+    if split_sentence: # xtts is imported, and its sentence splitting with it
+        language = voice_to_speaker.get().get('tts-1-hd', {}).get(voice, {}).get('language', 'auto') if model == 'tts-1-hd' else 'en'
+        try:
+            split = spacy_sentences('en' if language == 'auto' else language)
+        except ImportError as e:
+            logger.warning(f"Splitting sentences without spacy: {repr(e)}")
+    sentences = sentence_stream(split)
+    queued = asyncio.Queue() # sentences ... None
 
-        def cleanup():
-            ffmpeg_proc.kill()
-            del generator_worker
-            del out_writer_worker
+    async def receive():
+        try:
+            while True:
+                message = await websocket.receive_json()
+                for sentence in sentences.add(str(message.get('text', ''))):
+                    queued.put_nowait(sentence)
+                if message.get('flush', False) or message.get('end', False):
+                    for sentence in sentences.end():
+                        queued.put_nowait(sentence)
+                if message.get('end', False):
+                    break
+        except WebSocketDisconnect:
+            logger.info("Client disconnected")
+        except Exception as e:
+            logger.info(f"Invalid message: {repr(e)}")
+        finally:
+            queued.put_nowait(None)
+
+    async def pcm():
+        while (text := await queued.get()) is not None:
+            try:
+                response = await generate_speech(GenerateSpeechRequest(model=model, input=text, voice=voice, response_format='pcm', speed=speed),
+                                                 if_none_match=None, authorization=authorization, x_priority=x_priority)
+            except APIError as e: # Ex. nothing left after preprocess, or a 429
+                await websocket.send_json({ 'type': 'error', 'message': e.message, 'text': text })
+                continue
+
+            await websocket.send_json({ 'type': 'sentence', 'text': text })
+            async for chunk in speech_chunks(response):
+                yield chunk
+
+    receiver = asyncio.create_task(receive())
+    encoded = encoders.stream(pcm(), response_format, input_format="s16le", sample_rate=str(sample_rate))
+    try:
+        async for chunk in encoded.content:
+            await websocket.send_bytes(chunk)
+        if encoded.completed():
+            await websocket.send_json({ 'type': 'done' })
+        else:
+            await websocket.send_json({ 'type': 'error', 'message': "Speech generation failed" })
+        await websocket.close()
 
-        return StreamingResponse(content=ffmpeg_proc.stdout, media_type=media_type, background=cleanup)
-    else:
-        raise BadRequestError("No such model, must be tts-1 or tts-1-hd.", param='model')
+    except (WebSocketDisconnect, RuntimeError): # closed, Ex. while sending
+        pass
 
+    finally:
+        receiver.cancel()
+        encoded.close()
+
+@app.get("/v1/audio/speech/prerender")
+async def get_prerendered_speech():
+    # which of the phrases in config/prerender.yaml are ready, their size, and how many requests they answered
+    return prerendered.info()
+
+@app.post("/v1/audio/speech/batches")
+async def create_speech_batch(request: Request, archive: bool = False):
+    # the body is jsonl, one speech request per line with an optional custom_id
+    body = (await request.body()).decode('utf-8')
+    if not body.strip():
+        raise BadRequestError("Empty batch, send one speech request per line (jsonl)", param='body')
+    return batches.submit(body, archive=archive).info()
+
+@app.get("/v1/audio/speech/batches")
+async def list_speech_batches():
+    return { 'object': 'list', 'data': [job.info() for job in batches.jobs.values()] }
+
+@app.get("/v1/audio/speech/batches/{batch_id}")
+async def get_speech_batch(batch_id: str):
+    job = batches.get(batch_id)
+    if job is None:
+        raise NotFoundError(f"No such batch: {batch_id}", param='batch_id')
+    return job.info()
+
+@app.post("/v1/audio/speech/batches/{batch_id}/cancel")
+async def cancel_speech_batch(batch_id: str):
+    job = batches.cancel(batch_id)
+    if job is None:
+        raise NotFoundError(f"No such batch: {batch_id}", param='batch_id')
+    return job.info()
+
+@app.get("/v1/audio/speech/batches/{batch_id}/archive")
+async def get_speech_batch_archive(batch_id: str):
+    job = batches.get(batch_id)
+    if job is None or not job.archive:
+        raise NotFoundError(f"No archive for batch: {batch_id}", param='batch_id')
+    if job.status != 'completed':
+        raise BadRequestError(f"Batch {batch_id} is {job.status}, the archive is made when it's completed", param='batch_id')
+    return FileResponse(f"{job.output_dir}.zip", media_type="application/zip", filename=f"{batch_id}.zip")
+
+def start_piper_workers():
+    # a pool for each configured tts-1 voice
+    for voice, conf in voice_to_speaker.get().get('tts-1', {}).items():
+        piper_model = str(conf.get('model', ''))
+        if not os.path.exists(piper_model):
+            logger.debug(f"Not starting piper workers for {voice}, model not found: {piper_model}")
+            continue
+        try:
+            piper_workers.warmup(piper_model, conf.get('speaker', None), conf.get('workers', None))
+        except Exception as e:
+            logger.error(f"Failed to start piper workers for {voice}: {repr(e)}")
+
+async def warmup_model(model: str, preload: str = None, timeout: float = 120) -> bool:
+    # A short generation with a usable voice of the model (its piper model or xtts speaker is on disk, of the
+    # preloaded xtts model), the first is the slowest. A voice which fails is skipped for the next one.
+    def usable(conf: dict) -> bool:
+        if model == 'tts-1':
+            return os.path.exists(str(conf.get('model', '')))
+        return conf.get('model', None) == preload and os.path.exists(str(conf.get('speaker', '')))
+
+    for voice, conf in voice_to_speaker.get().get(model, {}).items():
+        if not usable(conf):
+            continue
+        try:
+            await asyncio.wait_for(render_speech({ 'model': model, 'voice': voice, 'input': "Hello.", 'response_format': 'pcm' }), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.error(f"Warming up {model} with {voice} took over {timeout}s, giving up")
+            return False
+        except Exception as e:
+            logger.error(f"Failed to warm up {model} with {voice}: {repr(e)}")
+
+    logger.warning(f"No usable {model} voice to warm up with")
+    return False
+
+# Runs when the server is listening, tts-1 is ready while tts-1-hd is still loading.
+startup_phases = {} # phase -> seconds
+
+async def start_models():
+    async def phase(name: str, run):
+        start = time.time()
+        await run
+        startup_phases[name] = time.time() - start
+        logger.info(f"Startup: {name} in {startup_phases[name]:.2f}s")
+
+    async def start_piper():
+        state = 'failed'
+        try:
+            if piper_workers:
+                await phase('piper workers', asyncio.to_thread(start_piper_workers))
+            if args.warmup_models:
+                await phase('tts-1 warmup', warmup_model('tts-1'))
+            state = 'ready'
+        finally: # never left starting
+            app.set_state('tts-1', state)
+            if not xtts_models:
+                app.set_state('tts-1-hd', state) # it's piper too
+
+    async def start_xtts():
+        state = 'failed'
+        try:
+            if args.preload:
+                app.set_state('tts-1-hd', 'loading')
+                try:
+                    await phase('xtts import', asyncio.to_thread(import_xtts))
+                    await phase('xtts load', xtts_models.get_async((args.preload, None)))
+                except Exception as e:
+                    logger.error(f"Failed to preload {args.preload}: {repr(e)}")
+                    return
+                if args.warmup_models:
+                    await phase('tts-1-hd warmup', warmup_model('tts-1-hd', args.preload))
+            state = 'ready' # otherwise it's loaded on first use
+        finally:
+            app.set_state('tts-1-hd', state)
+
+    startup_phases['server start'] = time.time() - process_start
+    logger.info(f"Startup: server started after {startup_phases['server start']:.2f}s")
+    await asyncio.gather(start_piper(), start_xtts() if xtts_models else asyncio.sleep(0))
+    logger.info(f"Ready after {time.time() - process_start:.2f}s (" + ', '.join(f"{name} {seconds:.2f}s" for name, seconds in startup_phases.items()) + ")")
+
+# 'auto' is resolved by import_xtts(), importing torch here would slow down every start
+def auto_torch_device():
+    return 'auto' if importlib.util.find_spec('torch') and importlib.util.find_spec('TTS') else 'none'
 
 # We return 'mps' but currently XTTS will not work with mps devices as the cuda support is incomplete
-def auto_torch_device():
-    try:
-        import torch
-        return 'cuda' if torch.cuda.is_available() else 'mps' if ( torch.backends.mps.is_available() and torch.backends.mps.is_built() ) else 'cpu'
-    
-    except:
-        return 'none'
+def torch_device():
+    return 'cuda' if torch.cuda.is_available() else 'mps' if ( torch.backends.mps.is_available() and torch.backends.mps.is_built() ) else 'cpu'
 
-if __name__ == "__main__":
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description='OpenedAI Speech API Server',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument('--xtts_device', action='store', default=auto_torch_device(), help="Set the device for the xtts model. The special value of 'none' will use piper for all models.")
-    parser.add_argument('--preload', action='store', default=None, help="Preload a model (Ex. 'xtts' or 'xtts_v2.0.2'). By default it's loaded on first use.")
+    parser.add_argument('--xtts_device', action='store', default=auto_torch_device(), help="Set the device for the xtts model (auto is cuda, mps or cpu). The special value of 'none' will use piper for all models.")
+    parser.add_argument('--preload', action='store', default=None, help="Preload a model (Ex. 'xtts' or 'xtts_v2.0.2') in the background after the server starts. By default it's loaded on first use.")
+    parser.add_argument('--warmup-models', action='store_true', default=False, help="Generate a short phrase with each model before it's ready (see /health), to prime the CUDA/ONNX kernels")
     parser.add_argument('--unload-timer', action='store', default=None, type=int, help="Idle unload timer for the XTTS model in seconds, Ex. 900 for 15 minutes")
+    parser.add_argument('--xtts-models-mb', action='store', default=0, type=int, help="Memory budget for loaded xtts models in MB, to keep several models (Ex. fine-tuned voices) loaded at once, the least recently used are unloaded first. 0 keeps only the last used model")
+    parser.add_argument('--xtts-batch-size', action='store', default=1, type=int, help="Maximum number of sentences from concurrent tts-1-hd requests to generate together in one xtts batch, 1 disables batching")
+    parser.add_argument('--xtts-batch-wait-ms', action='store', default=20, type=int, help="How long to wait for more sentences before starting an xtts batch, in milliseconds")
+    parser.add_argument('--reload-on-traffic', action='store_true', default=False, help="Reload xtts models which were unloaded by the --unload-timer in the background as soon as the next request comes in (for any model)")
+    parser.add_argument('--reload-at', action='store', default=None, help="Reload xtts models which were unloaded by the --unload-timer in the background at these times of the day, Ex. 07:30,13:00")
     parser.add_argument('--use-deepspeed', action='store_true', default=False, help="Use deepspeed with xtts (this option is unsupported)")
     parser.add_argument('--no-cache-speaker', action='store_true', default=False, help="Don't use the speaker wav embeddings cache")
+    parser.add_argument('--speaker-cache-dir', action='store', default=None, help="Also save the speaker wav embeddings to this directory, so they survive a restart, Ex. voices/latents")
+    parser.add_argument('--piper-workers', action='store', default=0, type=int, help="Number of persistent piper workers per tts-1 voice (can be set per voice with 'workers:'), 0 starts a new piper process for each request")
+    parser.add_argument('--piper-inprocess', action='store_true', default=False, help="Run piper voices inside the server process with a shared onnx session per model, instead of separate piper processes")
+    parser.add_argument('--piper-parallel', action='store', default=0, type=int, help="Split long tts-1 inputs into sentences and synthesize up to this many at the same time (implies at least as many --piper-workers, unless --piper-inprocess is used)")
+    parser.add_argument('--piper-cache-mb', action='store', default=1024, type=int, help="Memory budget for in process piper models in MB, the least recently used models are unloaded first")
+    parser.add_argument('--piper-threads', action='store', default=None, type=int, help="onnxruntime intra-op threads for each piper model (default is the number of cpu cores)")
+    parser.add_argument('--max-concurrent', action='store', default=None, help="Maximum requests generating at the same time for each model, Ex. 8 or tts-1=8,tts-1-hd=2. By default there is no limit")
+    parser.add_argument('--max-queue', action='store', default=None, help="Maximum requests waiting for their turn for each model with --max-concurrent, Ex. 16 or tts-1=32,tts-1-hd=4. Requests over the limit get a 429 with Retry-After. By default there is no limit")
+    parser.add_argument('--queue-timeout', action='store', default=30, type=float, help="Seconds a request can wait for its turn before it gets a 429")
+    parser.add_argument('--priority-keys', action='store', default=None, help="Priority classes (interactive, normal or bulk) for API keys, Ex. sk-app=interactive,sk-batch=bulk. Requests can also ask for a class with an 'X-Priority' header")
+    parser.add_argument('--batch-dir', action='store', default='config/batches', help="Directory for the output of batch jobs (/v1/audio/speech/batches)")
+    parser.add_argument('--batch-workers', action='store', default=1, type=int, help="Number of batch job items rendered at the same time")
+    parser.add_argument('--pcm-buffer-mb', action='store', default=256, type=int, help="Memory for the xtts audio waiting to be encoded and sent, for all the streams together. Generation waits when it's used up")
+    parser.add_argument('--pcm-stream-mb', action='store', default=8, type=int, help="Memory for the xtts audio waiting to be encoded and sent for each stream, a slow client makes its generation wait instead of buffering more")
+    parser.add_argument('--cache-mb', action='store', default=0, type=int, help="Size of the in memory cache for generated speech in MB, repeated requests are served from the cache. 0 disables the cache unless --cache-dir is set")
+    parser.add_argument('--cache-dir', action='store', default=None, help="Directory for the on disk speech cache, Ex. config/cache")
+    parser.add_argument('--cache-disk-mb', action='store', default=1024, type=int, help="Size limit of the on disk speech cache in MB")
+    parser.add_argument('--audio-encoder', action='store', default='ffmpeg', choices=['ffmpeg', 'pyav'], help="Encoder for mp3, opus, aac and flac. pyav encodes in the server process (pip install av). pcm and wav are always converted in process")
+    parser.add_argument('--ffmpeg-prespawn', action='store', default=0, type=int, help="Number of idle ffmpeg encoders to keep started for each output format, to hide the ffmpeg startup time")
     parser.add_argument('-P', '--port', action='store', default=8000, type=int, help="Server tcp port")
     parser.add_argument('-H', '--host', action='store', default='0.0.0.0', help="Host to listen on, Ex. 0.0.0.0")
+    parser.add_argument('--trace-log', action='store', default=None, help="Write a json record with the time spent in each stage of every request to this file (they are also logged with --log-level DEBUG)")
     parser.add_argument('-L', '--log-level', default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="Set the log level")
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
+# Everything the server needs before it takes requests, also used to run it in process (Ex. bench.py)
+def setup_server(server_args):
+    global args, encoders, speakers, speech_cache, piper_sessions, piper_workers, piper_sentences, xtts_models, api_key_priorities, batches, pcm_pool, prerendered
+    global language_detect
+    args = server_args
+    start = time.time()
 
     default_exists('config/pre_process_map.yaml')
     default_exists('config/voice_to_speaker.yaml')
 
     logger.remove()
     logger.add(sink=sys.stderr, level=args.log_level)
+    if args.log_level == 'DEBUG':
+        app.add_middleware(log_requests)
+    if args.trace_log:
+        trace_sink(args.trace_log)
 
     if args.xtts_device != "none":
-        import torch
-        from TTS.tts.configs.xtts_config import XttsConfig
-        from TTS.tts.models.xtts import Xtts
-        from TTS.utils.manage import ModelManager
-        from TTS.tts.layers.xtts.tokenizer import split_sentence
-        from langdetect import detect
+        language_detect = language_detector()
+        threading.Thread(target=language_detect.load, daemon=True).start()
+
+    encoders = audio_encoders(backend=args.audio_encoder, prespawn=args.ffmpeg_prespawn)
+    pcm_pool = pcm_frames(max_mb=args.pcm_buffer_mb)
+
+    max_queue = per_model(args.max_queue, ['tts-1', 'tts-1-hd'])
+    for model, max_active in per_model(args.max_concurrent, ['tts-1', 'tts-1-hd']).items():
+        if max_active > 0:
+            admission[model] = admission_gate(model, max_active, max_queue=max_queue.get(model), timeout=args.queue_timeout)
+    api_key_priorities = priority_keys(args.priority_keys)
+
+    if not args.no_cache_speaker:
+        speakers = speaker_cache(cache_dir=args.speaker_cache_dir)
+
+    if args.cache_mb > 0 or args.cache_dir:
+        speech_cache = response_cache(max_mb=args.cache_mb, cache_dir=args.cache_dir, max_disk_mb=args.cache_disk_mb)
+
+    if args.piper_inprocess:
+        piper_sessions = piper_session_cache(max_mb=args.piper_cache_mb, intra_op_threads=args.piper_threads)
 
-    if args.preload:
-        xtts = xtts_wrapper(args.preload, device=args.xtts_device, unload_timer=args.unload_timer)
+    elif args.piper_workers > 0 or args.piper_parallel > 1:
+        piper_workers = piper_pool(workers_per_voice=max(args.piper_workers, args.piper_parallel), intra_op_threads=args.piper_threads)
+
+    if args.piper_parallel > 1:
+        piper_sentences = piper_parallel(piper_sessions or piper_workers, parallel=args.piper_parallel)
+
+    if args.xtts_device != "none":
+        xtts_models = model_registry(load_xtts, max_mb=args.xtts_models_mb, idle_timeout=args.unload_timer, name='xtts', label=lambda key: key[0])
+        if args.reload_at:
+            xtts_models.wake_at(args.reload_at.split(','))
+
+    prerendered = prerender_store(render_speech, speech_key, prerender_phrases.get)
+    batches = batch_runner(render_speech, lambda item: GenerateSpeechRequest(**item), args.batch_dir, workers=args.batch_workers, busy=metrics.active_streams.total)
 
     app.register_model('tts-1')
-    app.register_model('tts-1-hd')
+    app.register_model('tts-1-hd', status=xtts_status if xtts_models else None)
+    app.set_state('tts-1', 'starting')
+    app.set_state('tts-1-hd', 'starting')
+    startup_phases['setup'] = time.time() - start
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_server(args)
 
     uvicorn.run(app, host=args.host, port=args.port)
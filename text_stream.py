@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Text deltas (Ex. the tokens of an llm, as they are generated) -> sentences, for the speech websocket.
+#
+# A sentence is complete when the text after it starts the next one, so the last one is held until more text
+# comes, or the end. The sentences are found the way xtts split_sentence() does (spacy's sentencizer), but they
+# aren't merged up to the length limit, so the first one can be spoken right away.
+import functools
+import re
+
+END_OF_SENTENCE = re.compile(r'(?<=[.!?。！？])\s+')
+
+def regex_sentences(text: str) -> list:
+    # without spacy (Ex. piper only), punctuation followed by a space
+    return END_OF_SENTENCE.split(text)
+
+@functools.lru_cache()
+def spacy_sentences(language: str):
+    from TTS.tts.layers.xtts.tokenizer import get_spacy_lang
+
+    nlp = get_spacy_lang('zh' if language == 'zh-cn' else language)
+    nlp.add_pipe('sentencizer')
+    return lambda text: [sentence.text for sentence in nlp(text).sents]
+
+class sentence_stream():
+    def __init__(self, split, max_chars: int = 250):
+        self.split = split # text -> sentences
+        self.max_chars = max_chars # text without an end of sentence is cut at a space after this
+        self.text = ''
+
+    def add(self, delta: str) -> list:
+        # -> the sentences completed by delta
+        self.text += delta
+        if not self.text.strip():
+            return []
+
+        sentences = [sentence for sentence in self.split(self.text) if sentence.strip()]
+        if len(sentences) < 2:
+            cut = self.text.rfind(' ', 0, self.max_chars) if len(self.text) > self.max_chars else -1
+            if cut > 0:
+                sentence, self.text = self.text[:cut].strip(), self.text[cut + 1:]
+                return [sentence]
+            return []
+
+        # the last one keeps its spacing, Ex. 'How ' + 'are'
+        last = self.text.rfind(sentences[-1])
+        self.text = self.text[last:] if last >= 0 else sentences[-1]
+        return [sentence.strip() for sentence in sentences[:-1]]
+
+    def end(self) -> list:
+        # -> the rest of the text
+        text, self.text = self.text.strip(), ''
+        return [text] if text else []
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Streaming time stretch (WSOLA) of the generated pcm, in process and without changing the pitch.
+#
+# The models only change their speed well within a limited range (Ex. xtts 0.5 - 1.0), the rest of the
+# 0.25 - 4.0 speed range of the API is done here, on the pcm chunks before they are encoded. Frames of the input
+# are taken speed times further apart than they are overlapped in the output, each one shifted a little to where
+# it best continues the previous frame, so there is no phasing. The output follows the input with a delay of
+# about one frame (30ms).
+import numpy as np
+
+from audio_encoder import to_float, to_s16le
+
+def split_speed(speed: float, low: float, high: float) -> tuple:
+    # speed -> (model speed within low - high, time stretch for the rest)
+    model_speed = min(max(speed, low), high)
+    return model_speed, speed / model_speed
+
+class wsola_stretch():
+    def __init__(self, speed: float, sample_rate: int, frame_ms: int = 30):
+        self.speed = speed
+        self.n = max(64, int(sample_rate * frame_ms / 1000) // 2 * 2) # frame length
+        self.hs = self.n // 2 # output hop, 50% overlap
+        self.ha = self.hs * speed # input hop
+        self.tol = self.n // 4 # how far a frame can be shifted
+        self.window = np.hanning(self.n + 1)[:-1].astype(np.float32) # periodic, sums to 1 at 50% overlap
+        self.first_window = self.window.copy()
+        self.first_window[:self.hs] = 1.0 # nothing before the first frame to fade in from
+        self.buf = np.zeros(0, dtype=np.float32)
+        self.offset = 0 # input position of buf[0]
+        self.received = 0 # input samples
+        self.sent = 0 # output samples
+        self.k = 0 # next frame
+        self.prev = None # input position of the previous frame
+        self.ola = np.zeros(self.n, dtype=np.float32)
+
+    def _seg(self, pos: int, length: int) -> np.ndarray:
+        return self.buf[pos - self.offset:pos - self.offset + length]
+
+    def _needed(self, nominal: int) -> int:
+        # input needed to place the frame at nominal
+        if self.prev is None:
+            return nominal + self.n
+        return max(nominal + self.tol + self.n, self.prev + self.hs + self.n)
+
+    def _frame(self, nominal: int) -> np.ndarray:
+        if self.prev is None:
+            pos = nominal
+        else:
+            # the best match for the natural continuation of the previous frame, around nominal
+            template = self._seg(self.prev + self.hs, self.n)
+            lo = max(nominal - self.tol, 0)
+            region = self._seg(lo, nominal + self.tol + self.n - lo)
+            corr = np.correlate(region, template, 'valid')
+            energy = np.cumsum(np.concatenate([[0.0], region.astype(np.float64) ** 2]))
+            energy = energy[self.n:] - energy[:-self.n] # of each candidate, so louder ones aren't favored
+            pos = lo + int(np.argmax(corr / np.sqrt(np.maximum(energy, 1e-9))))
+
+        window = self.first_window if self.prev is None else self.window
+        self.prev = pos
+        self.k += 1
+
+        self.ola += self._seg(pos, self.n) * window
+        out = self.ola[:self.hs].copy()
+        self.ola[:self.n - self.hs] = self.ola[self.hs:]
+        self.ola[self.n - self.hs:] = 0.0
+        return out
+
+    def _run(self, final: bool = False) -> np.ndarray:
+        out = []
+        while True:
+            nominal = int(round(self.k * self.ha))
+            if final:
+                if nominal >= self.received:
+                    break
+                short = self._needed(nominal) - (self.offset + len(self.buf))
+                if short > 0: # past the end of the input
+                    self.buf = np.concatenate([self.buf, np.zeros(short, dtype=np.float32)])
+            elif self._needed(nominal) > self.received:
+                break
+            out.append(self._frame(nominal))
+
+        # drop the input which no frame will use again
+        nominal = int(round(self.k * self.ha))
+        keep = min(nominal - self.tol, self.prev + self.hs) if self.prev is not None else nominal
+        if keep > self.offset:
+            self.buf = self.buf[keep - self.offset:]
+            self.offset = keep
+
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.float32)
+
+    def process(self, pcm: np.ndarray) -> np.ndarray:
+        pcm = to_float(pcm)
+        self.buf = np.concatenate([self.buf, pcm]) if len(self.buf) else pcm.astype(np.float32)
+        self.received += len(pcm)
+        out = self._run()
+        self.sent += len(out)
+        return out
+
+    def flush(self) -> np.ndarray:
+        out = np.concatenate([self._run(final=True), self.ola[:self.n - self.hs]])
+        out = out[:max(0, int(round(self.received / self.speed)) - self.sent)] # the length is exactly scaled
+        self.sent += len(out)
+        return out
+
+async def stretch_pcm(pcm_iter, input_format: str, sample_rate: int, speed: float):
+    # async iterator of raw f32le or s16le pcm -> the same, speed times faster
+    dtype = np.dtype('<f4') if input_format == 'f32le' else np.dtype('<i2')
+    stretch = wsola_stretch(speed, int(sample_rate))
+
+    def to_bytes(pcm: np.ndarray) -> bytes:
+        return pcm.astype(dtype).tobytes() if input_format == 'f32le' else to_s16le(pcm)
+
+    rest = b''
+    try:
+        async for chunk in pcm_iter:
+            if rest:
+                chunk = rest + chunk
+            n = len(chunk) - len(chunk) % dtype.itemsize
+            rest = chunk[n:]
+            out = stretch.process(np.frombuffer(chunk, dtype=dtype, count=n // dtype.itemsize))
+            if len(out):
+                yield to_bytes(out)
+
+        out = stretch.flush()
+        if len(out):
+            yield to_bytes(out)
+    finally:
+        await pcm_iter.aclose()
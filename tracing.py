@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Per request stage timings. The stages before the response starts are sent in a Server-Timing header, and all
+# of them are logged as one json record when the response is done (at debug level, or to a file with --trace-log).
+import json
+import threading
+import time
+
+from loguru import logger
+
+class _span():
+    # with trace.span(name): adds the time spent in the block to the stage
+    def __init__(self, trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, time.time() - self.start)
+
+class request_trace():
+    def __init__(self, **info):
+        self.start = time.time()
+        self.info = info # Ex. model, voice, format
+        self.stages = {} # name -> seconds, added up if it happens more than once (Ex. for each sentence)
+        self.marks = {} # name -> seconds since the start, the first time it happened (Ex. first_pcm)
+        self.lock = threading.Lock() # xtts stages are added from the generator thread
+        self.finished = False
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def span(self, name: str) -> _span:
+        return _span(self, name)
+
+    def mark(self, name: str):
+        with self.lock:
+            self.marks.setdefault(name, time.time() - self.start)
+
+    def server_timing(self) -> str:
+        with self.lock:
+            timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        timings.append(f"total;dur={(time.time() - self.start) * 1000:.1f}")
+        return ', '.join(timings)
+
+    def finish(self, status: str = 'ok', **info):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            record = {
+                'event': 'speech',
+                **self.info,
+                **info,
+                'status': status,
+                'total_ms': round((time.time() - self.start) * 1000, 1),
+                'stages_ms': { name: round(seconds * 1000, 1) for name, seconds in self.stages.items() },
+                'marks_ms': { name: round(seconds * 1000, 1) for name, seconds in self.marks.items() },
+            }
+        # lazy, the record is only formatted if a sink wants it
+        logger.bind(request_trace=True).opt(lazy=True).debug("{}", lambda: json.dumps(record))
+
+def trace_sink(path: str):
+    # one json record per line, only the request traces
+    logger.add(path, level='DEBUG', format='{message}', filter=lambda record: 'request_trace' in record['extra'])
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Batched xtts inference: sentences from concurrent tts-1-hd requests are run through the GPT decoder together.
+#
+# Each request queues all of its sentences, and a single scheduler thread builds a batch from the oldest
+# waiting sentence of up to max_batch different requests (waiting up to max_wait for more to arrive).
+# Only sentences with the same sampling settings can share a batch, the speaker latents, language and
+# speed are per sentence. The prefixes are left padded with an attention mask, xtts doesn't use GPT2
+# position embeddings so the padding doesn't change the output. Audio is decoded per sentence every
+# stream_chunk_size tokens and sent back to its request as soon as it's ready, like inference_stream().
+import collections
+import queue
+import threading
+import time
+
+from loguru import logger
+
+import metrics
+
+class xtts_job():
+    # one sentence of a request
+    def __init__(self, request, text: str, language: str, settings: dict, speed: float):
+        self.request = request
+        self.text = text
+        self.language = language
+        self.settings = settings
+        self.speed = speed
+        self.chunks = queue.Queue() # pcm arrays ... None | Exception
+        self.queued = time.time()
+
+    def batch_key(self):
+        return tuple(sorted((k, repr(v)) for k, v in self.settings.items()))
+
+class xtts_request():
+    def __init__(self, gpt_cond_latent, speaker_embedding):
+        self.gpt_cond_latent = gpt_cond_latent
+        self.speaker_embedding = speaker_embedding
+        self.jobs = collections.deque() # waiting sentences, in order
+        self.cancelled = False
+
+class xtts_batcher():
+    def __init__(self, wrapper, max_batch: int = 4, max_wait: float = 0.02):
+        self.wrapper = wrapper # xtts_wrapper, for the model and its lock
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = collections.deque() # requests with waiting sentences, oldest first
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.batches = 0
+        self.batched = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def tts(self, all_text: list, language: str, gpt_cond_latent, speaker_embedding, speed: float = 1.0, enable_text_splitting=None, **settings):
+        # yields f32le pcm for all the sentences, in order. text splitting is done by the caller.
+        request = xtts_request(gpt_cond_latent, speaker_embedding)
+        jobs = [xtts_job(request, text, language, settings, speed) for text in all_text]
+
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError("xtts batcher stopped")
+            request.jobs.extend(jobs)
+            self.requests.append(request)
+            self.cond.notify()
+
+        try:
+            for job in jobs:
+                while True:
+                    chunk = job.chunks.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, BaseException):
+                        raise chunk
+                    yield chunk
+        finally:
+            with self.cond:
+                request.cancelled = True
+                request.jobs.clear()
+
+    def _next_batch(self) -> list:
+        # the oldest waiting sentence of each request, up to max_batch, all with the same settings
+        with self.cond:
+            while not self.stopped and not self.requests:
+                self.cond.wait()
+
+            deadline = time.time() + self.max_wait
+            while not self.stopped and len(self.requests) < self.max_batch and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+
+            if self.stopped:
+                return []
+
+            batch = []
+            key = None
+            for request in list(self.requests):
+                if request.cancelled or not request.jobs:
+                    self.requests.remove(request)
+                    continue
+                if len(batch) >= self.max_batch:
+                    break
+                job = request.jobs[0]
+                if key is None:
+                    key = job.batch_key()
+                elif job.batch_key() != key:
+                    continue
+                batch.append(request.jobs.popleft())
+                self.requests.remove(request)
+                if request.jobs: # to the back of the line until this sentence is done
+                    self.requests.append(request)
+
+            return batch
+
+    def run(self):
+        while not self.stopped:
+            batch = self._next_batch()
+            if not batch:
+                continue
+
+            self.batches += 1
+            self.batched += len(batch)
+            try:
+                for job in batch:
+                    metrics.lock_wait.observe(time.time() - job.queued, model=self.wrapper.model_name)
+                self.generate(batch)
+            except Exception as e:
+                logger.error(f"Exception: {repr(e)}")
+                for job in batch:
+                    job.chunks.put(e)
+
+    def generate(self, batch: list):
+        import torch
+        import torch.nn.functional as F
+
+        xtts = self.wrapper.xtts
+        gpt = xtts.gpt
+        device = xtts.device
+        settings = dict(batch[0].settings)
+        stream_chunk_size = settings.pop('stream_chunk_size', 20)
+        overlap_wav_len = settings.pop('overlap_wav_len', 1024)
+        generate_kwargs = dict(
+            top_k=settings.pop('top_k', 50),
+            top_p=settings.pop('top_p', 0.85),
+            temperature=settings.pop('temperature', 0.75),
+            do_sample=settings.pop('do_sample', True),
+            length_penalty=float(settings.pop('length_penalty', 1.0)),
+            repetition_penalty=float(settings.pop('repetition_penalty', 10.0)),
+            **settings,
+        )
+
+        logger.debug(f"xtts batch of {len(batch)}: {[job.text for job in batch]}")
+        start = time.time()
+
+        with torch.no_grad(), self.wrapper.lock:
+            # prefix embeddings (speaker latents + text) for each sentence, left padded to the same length
+            prefixes = []
+            for job in batch:
+                text_tokens = torch.IntTensor(xtts.tokenizer.encode(job.text.strip().lower(), lang=job.language.split('-')[0])).unsqueeze(0).to(device)
+                gpt.compute_embeddings(job.request.gpt_cond_latent.to(device), text_tokens)
+                prefixes.append(gpt.gpt_inference.cached_prefix_emb)
+
+            prefix_len = max(p.shape[1] for p in prefixes)
+            prefix = prefixes[0].new_zeros((len(batch), prefix_len, prefixes[0].shape[2]))
+            attention_mask = torch.zeros((len(batch), prefix_len + 1), dtype=torch.long, device=device)
+            for i, p in enumerate(prefixes):
+                prefix[i, prefix_len - p.shape[1]:] = p[0]
+                attention_mask[i, prefix_len - p.shape[1]:] = 1
+
+            gpt.gpt_inference.store_prefix_emb(prefix)
+            fake_inputs = torch.full((len(batch), prefix_len + 1), fill_value=1, dtype=torch.long, device=device)
+            fake_inputs[:, -1] = gpt.start_audio_token
+
+            gpt_generator = gpt.get_generator(
+                fake_inputs=fake_inputs,
+                attention_mask=attention_mask,
+                num_beams=1,
+                num_return_sequences=1,
+                output_attentions=False,
+                output_hidden_states=True,
+                **generate_kwargs,
+            )
+
+        latents = [[] for _ in batch]
+        new_tokens = [0] * len(batch)
+        ended = [False] * len(batch)
+        wav_state = [(None, None)] * len(batch) # wav_gen_prev, wav_overlap
+
+        def decode(i):
+            job = batch[i]
+            gpt_latents = torch.cat(latents[i], dim=0)[None, :]
+            length_scale = 1.0 / max(job.speed, 0.05)
+            if length_scale != 1.0:
+                gpt_latents = F.interpolate(gpt_latents.transpose(1, 2), scale_factor=length_scale, mode="linear").transpose(1, 2)
+            wav_gen = xtts.hifigan_decoder(gpt_latents, g=job.request.speaker_embedding.to(device))
+            wav_chunk, wav_gen_prev, wav_overlap = xtts.handle_chunks(wav_gen.squeeze(), *wav_state[i], overlap_wav_len)
+            wav_state[i] = (wav_gen_prev, wav_overlap)
+            new_tokens[i] = 0
+            if not job.request.cancelled:
+                job.chunks.put(wav_chunk.cpu().numpy())
+
+        while True:
+            with torch.no_grad(), self.wrapper.lock:
+                try:
+                    tokens, latent = next(gpt_generator)
+                except StopIteration:
+                    tokens = None
+
+                for i, job in enumerate(batch):
+                    if ended[i]:
+                        continue
+                    if tokens is None:
+                        ended[i] = True
+                    else:
+                        latents[i].append(latent[i:i + 1])
+                        new_tokens[i] += 1
+                        ended[i] = int(tokens[i]) == gpt.stop_audio_token
+                    if ended[i] or new_tokens[i] >= stream_chunk_size:
+                        if latents[i]:
+                            decode(i)
+                        if ended[i]:
+                            job.chunks.put(None)
+
+                self.wrapper.last_used = time.time()
+
+            if tokens is None or all(ended):
+                break
+
+            if all(job.request.cancelled for job in batch):
+                logger.info("Client disconnected")
+                break
+
+        gpt_generator.close()
+
+        tokens = sum(len(l) for l in latents)
+        if tokens:
+            metrics.tokens_per_second.observe(tokens / (time.time() - start), model=self.wrapper.model_name)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            for request in self.requests:
+                for job in request.jobs:
+                    job.chunks.put(RuntimeError("xtts model unloaded"))
+            self.requests.clear()
+            self.cond.notify_all()